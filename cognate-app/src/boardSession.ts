@@ -0,0 +1,116 @@
+import type { CognateApp } from './types';
+
+// Board kept by the server (see server/board_store.py). The whole board is
+// uploaded once, then requests send its session id and the column and board
+// edits made since the server last saw it, in place of the board.
+export class BoardSession {
+    private rootUrl: string;
+    private id: string = null;
+    // The syllables the server's board was uploaded with
+    private syllables: CognateApp["syllables"] = null;
+    // Columns and boards as the server has them, serialized
+    private columns = new Map<string, string>();
+    private boards = new Map<string, string>();
+
+    constructor(rootUrl: string) {
+        this.rootUrl = rootUrl;
+    }
+
+    // Forgets the server's board, e.g. when another board is loaded
+    reset() {
+        this.id = null;
+        this.syllables = null;
+    }
+
+    // Remembers the columns and boards of data as the server has them
+    remember(data: CognateApp) {
+        [this.columns, this.boards] = serialize(data);
+    }
+
+    private async upload(data: CognateApp) {
+        const res = await fetch(`${this.rootUrl}/boards`, {
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json"
+            },
+            body: JSON.stringify({
+                columns: data.columns,
+                boards: data.boards,
+                syllables: data.syllables,
+                fstDoculects: data.fstDoculects
+            })
+        });
+        if (!res.ok) {
+            throw new Error(`Could not upload the board (${res.status})`);
+        }
+        this.id = (await res.json()).boardSession;
+        this.syllables = data.syllables;
+        this.remember(data);
+    }
+
+    // POSTs body to path, with the board of data sent as { boardSession, boardEdits }.
+    // The board is uploaded first if the server doesn't have it yet, and again
+    // if the server forgot it (410). Once the server answers, the edits count as
+    // sent; sending them again would do no harm, as they replace whole columns
+    // and boards.
+    async post(path: string, body: object, data: CognateApp, headers: object = {}) {
+        for (let attempt = 0; ; attempt++) {
+            if (this.id == null || this.syllables !== data.syllables) {
+                await this.upload(data);
+            }
+            const [columns, boards] = serialize(data);
+            const res = await fetch(`${this.rootUrl}${path}`, {
+                method: "POST",
+                headers: {
+                    "Content-Type": "application/json",
+                    ...headers
+                },
+                body: JSON.stringify({
+                    ...body,
+                    boardSession: this.id,
+                    boardEdits: this.edits(columns, boards)
+                })
+            });
+            if (res.status == 410 && attempt == 0) {
+                this.reset();
+                continue;
+            }
+            if (res.status != 400 && res.status != 410) {
+                this.columns = columns;
+                this.boards = boards;
+            }
+            return res;
+        }
+    }
+
+    // Column and board edits since the server last saw the board
+    private edits(columns: Map<string, string>, boards: Map<string, string>) {
+        let edits = [];
+        for (const [columnId, column] of columns) {
+            if (this.columns.get(columnId) !== column) {
+                edits.push({ op: "column", columnId, column: JSON.parse(column) });
+            }
+        }
+        for (const columnId of this.columns.keys()) {
+            if (!columns.has(columnId)) {
+                edits.push({ op: "delete-column", columnId });
+            }
+        }
+        for (const [boardId, board] of boards) {
+            if (this.boards.get(boardId) !== board) {
+                edits.push({ op: "board", boardId, board: JSON.parse(board) });
+            }
+        }
+        for (const boardId of this.boards.keys()) {
+            if (!boards.has(boardId)) {
+                edits.push({ op: "delete-board", boardId });
+            }
+        }
+        return edits;
+    }
+}
+
+const serialize = (data: CognateApp): [Map<string, string>, Map<string, string>] => [
+    new Map(Object.entries(data.columns).map(([k, v]) => [k, JSON.stringify(v)])),
+    new Map(Object.entries(data.boards).map(([k, v]) => [k, JSON.stringify(v)]))
+];
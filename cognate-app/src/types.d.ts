@@ -51,6 +51,8 @@ export interface FstComparison {
         r: Section[],
         t: Section[]
     },
+    missing_transducers: string[],
+    errors: string[]
 }
 
 export interface Section {
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# Memoized transducer application
+#
+# Results of FST.apply_up / FST.apply_down are remembered by (network digest,
+# direction, input), so the same syllable is only ever looked up once per
+# compiled network. Results are kept in an in-memory LRU and, when
+# CAPR_APPLY_CACHE_DB names a file, in an SQLite database that survives
+# server restarts. Since the key is the digest of the compiled network, any
+# edit that leaves a doculect's network unchanged keeps its results.
+#
+# Usage:
+#   from apply_cache import apply_up, apply_up_many
+#   apply_up(fsts["Maru"], "kaŋ")  # → tuple of reconstructions
+#   apply_up_many(fsts["Maru"], ["kaŋ", "ma"])  # → {"kaŋ": (...), "ma": (...)}
+#
+# Passing every attested syllable of a doculect to apply_up_many at once
+# builds its whole syllable → reconstructions table from the transducer
+# restricted to those syllables, and later lookups are cache hits.
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Number of results held in memory
+APPLY_CACHE_SIZE = int(os.environ.get("CAPR_APPLY_CACHE_SIZE", 1000000))
+# Optional SQLite database holding results across restarts
+APPLY_CACHE_DB = os.environ.get("CAPR_APPLY_CACHE_DB")
+
+# Batches of at least this many uncached words are applied up by composing the
+# transducer with a wordlist of them (see FST.apply_up_wordlist)
+APPLY_WORDLIST_MIN = int(os.environ.get("CAPR_APPLY_WORDLIST_MIN", 200))
+
+# Pending results are written to the database in batches
+FLUSH_ENTRIES = 1000
+FLUSH_SECONDS = 5
+
+
+class ApplyCache(object):
+    """
+    LRU cache of transducer application results, optionally backed by an
+    SQLite database.
+    """
+
+    def __init__(self, max_entries, db_path=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (digest, direction, word) -> tuple
+        self.lock = threading.Lock()
+        self.db_path = db_path
+        self.db = None
+        self.db_pid = None
+        self.pending = []
+        self.last_flush = time.monotonic()
+        if db_path:
+            self._connect()
+            atexit.register(self.flush)
+
+    def _connect(self):
+        # An SQLite connection can't be used across fork(), so every process
+        # (e.g. each gunicorn worker after --preload) opens its own
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db_pid = os.getpid()
+        self.pending = []
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS apply ("
+            "network TEXT, direction TEXT, input TEXT, output TEXT, "
+            "PRIMARY KEY (network, direction, input))"
+        )
+        self.db.commit()
+
+    def apply(self, fst, direction, word):
+        """Apply fst to word in direction ("up" or "down"), memoized."""
+        return self.apply_many(fst, direction, [word])[word]
+
+    def apply_many(self, fst, direction, words):
+        """
+        Apply fst to every word in direction ("up" or "down"), memoized.
+        Returns {word: tuple of outputs}; misses are computed together with
+        FST.apply_up_many / FST.apply_down_many, or FST.apply_up_wordlist
+        for large batches.
+        """
+        digest = fst.digest()
+        results = {}
+        missing = []
+        with self.lock:
+            for word in dict.fromkeys(words):
+                result = self.entries.get((digest, direction, word))
+                if result is None:
+                    missing.append(word)
+                else:
+                    self.entries.move_to_end((digest, direction, word))
+                    results[word] = result
+            if missing:
+                found = self._lookup_db(digest, direction, missing)
+                results.update(found)
+                missing = [word for word in missing if word not in found]
+                for word, result in found.items():
+                    self._remember((digest, direction, word), result)
+
+        if missing:
+            if direction == "up" and len(missing) >= APPLY_WORDLIST_MIN:
+                computed = fst.apply_up_wordlist(missing)
+            elif direction == "up":
+                computed = fst.apply_up_many(missing)
+            else:
+                computed = fst.apply_down_many(missing)
+            results.update(computed)
+            with self.lock:
+                for word, result in computed.items():
+                    self._remember((digest, direction, word), result)
+                    self._store_db((digest, direction, word), result)
+        return results
+
+    def _remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _lookup_db(self, digest, direction, words):
+        if self.db is None:
+            return {}
+        if self.db_pid != os.getpid():
+            self._connect()
+        found = {}
+        for start in range(0, len(words), 500):
+            chunk = words[start : start + 500]
+            rows = self.db.execute(
+                "SELECT input, output FROM apply WHERE network = ? AND direction = ?"
+                " AND input IN (%s)" % ", ".join("?" * len(chunk)),
+                [digest, direction] + chunk,
+            )
+            for word, output in rows:
+                found[word] = tuple(json.loads(output))
+        return found
+
+    def _store_db(self, key, result):
+        if self.db is None:
+            return
+        if self.db_pid != os.getpid():
+            self._connect()
+        self.pending.append(key + (json.dumps(result, ensure_ascii=False),))
+        if (
+            len(self.pending) >= FLUSH_ENTRIES
+            or time.monotonic() - self.last_flush > FLUSH_SECONDS
+        ):
+            self._flush()
+
+    def _flush(self):
+        if self.db_pid != os.getpid():
+            self._connect()
+        if self.pending:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO apply VALUES (?, ?, ?, ?)", self.pending
+            )
+            self.db.commit()
+            self.pending = []
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        """Write pending results to the database."""
+        if self.db is not None:
+            with self.lock:
+                self._flush()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+apply_cache = ApplyCache(APPLY_CACHE_SIZE, APPLY_CACHE_DB)
+
+
+def apply_up(fst, word):
+    """Memoized tuple(fst.apply_up(word))."""
+    return apply_cache.apply(fst, "up", word)
+
+
+def apply_down(fst, word):
+    """Memoized tuple(fst.apply_down(word))."""
+    return apply_cache.apply(fst, "down", word)
+
+
+def apply_up_many(fst, words):
+    """Memoized fst.apply_up_many(words)."""
+    return apply_cache.apply_many(fst, "up", words)
+
+
+def apply_down_many(fst, words):
+    """Memoized fst.apply_down_many(words)."""
+    return apply_cache.apply_many(fst, "down", words)
+
+
+def apply_up_by_doculect(fsts, forms):
+    """
+    Memoized apply up of (doculect, form) pairs, one batch per doculect.
+    Returns {doculect: {form: tuple of outputs}}; doculects missing from fsts
+    are left out.
+    """
+    forms_of_doculect = {}
+    for doculect, form in forms:
+        if doculect in fsts:
+            forms_of_doculect.setdefault(doculect, []).append(form)
+    return {
+        doculect: apply_up_many(fsts[doculect], doculect_forms)
+        for doculect, doculect_forms in forms_of_doculect.items()
+    }
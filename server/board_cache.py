@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# Cache of compiled /new-board payloads
+#
+# A board only depends on the data file, the transducer and the cognate
+# column, so the serialized board is kept under a key made of the data file's
+# path, mtime and size, the hash of the transducer text and the column name.
+# Each entry carries a strong ETag (the hash of the payload) that the server
+# compares with If-None-Match.
+#
+# Usage:
+#   etag, body = compiled_board("burmish-aligned-final.tsv", transducer_text)
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from compile_lexicon_to_json import compile_to_json_full_cognates, read_transducer
+from fst_cache import script_hash
+
+# Upper bound (in bytes of serialized JSON) of the cached boards
+BOARD_CACHE_BYTES = int(os.environ.get("CAPR_BOARD_CACHE_BYTES", 64 * 1024 * 1024))
+
+DATA_DIR = "/usr/app/data"
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class BoardCache(object):
+    """LRU cache of serialized boards, bounded by their total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (etag, body)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        return None
+
+    def add(self, key, etag, body):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries[key][1])
+            self.entries[key] = (etag, body)
+            self.entries.move_to_end(key)
+            self.size += len(body)
+            # always keep the newest board, even if it is over budget on its own
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_body) = self.entries.popitem(last=False)
+                self.size -= len(evicted_body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+boards = BoardCache(BOARD_CACHE_BYTES)
+
+
+def board_key(path, transducer="internal", cognates="COGIDS"):
+    """Key of the board compiled from these arguments, as in compiled_board."""
+    stat = os.stat(os.path.join(DATA_DIR, path))
+    pipeline_name = path.split("-")[0]
+    return (
+        path,
+        stat.st_mtime_ns,
+        stat.st_size,
+        script_hash(read_transducer(pipeline_name, transducer)),
+        cognates,
+    )
+
+
+def compiled_board(path, transducer="internal", cognates="COGIDS"):
+    """
+    Serialized result of compile_to_json_full_cognates, compiled on a miss.
+
+    :return: (etag, body) where body is the board as UTF-8 encoded JSON
+    """
+    key = board_key(path, transducer, cognates)
+    cached = boards.get(key)
+    if cached is not None:
+        eprint(f"Board found in cache ({cached[0][:12]})")
+        return cached
+
+    board = compile_to_json_full_cognates(path, transducer, cognates=cognates)
+    body = json.dumps(board, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = hashlib.sha256(body).hexdigest()
+    boards.add(key, etag, body)
+    return etag, body
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# Server-side store of the boards the interface is working on
+#
+# Instead of posting its whole board (columns, boards, syllables and
+# fstDoculects, megabytes for Burmish) with every refish or comparison, the
+# interface uploads it once and gets a board session id. Later requests send
+# the session id as "boardSession" and, in "boardEdits", what changed since
+# they last did, in the same form as refish edits:
+#
+#   {"op": "column", "columnId": ..., "column": {...}}   add or replace a column
+#   {"op": "delete-column", "columnId": ...}
+#   {"op": "board", "boardId": ..., "board": {...}}      add or replace a board
+#   {"op": "delete-board", "boardId": ...}
+#
+# Boards are kept in memory with least-recently-used eviction. Every board is
+# also written to an SQLite database when it is uploaded or replaced, and each
+# batch of edits is appended to it, so any worker can rebuild a board from the
+# last copy and the edits made since; evicted boards are written back whole.
+#
+# Usage:
+#   session_id = board_store.create(board)
+#   board_store.update(session_id, edits)
+#   version, board = board_store.get(session_id)  # board: {"columns", ...}
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Number of boards held in memory per worker
+BOARD_STORE_SESSIONS = int(os.environ.get("CAPR_BOARD_STORE_SESSIONS", 4))
+# SQLite database boards are spilled to
+BOARD_STORE_DB = os.environ.get(
+    "CAPR_BOARD_STORE_DB", os.path.join(tempfile.gettempdir(), "capr-boards.db")
+)
+# Seconds a board session is kept after it last changed
+BOARD_STORE_TTL = float(os.environ.get("CAPR_BOARD_STORE_TTL", 7 * 24 * 3600))
+
+# Parts of a board kept in a session
+BOARD_FIELDS = ("columns", "boards", "syllables", "fstDoculects")
+
+
+class UnknownBoard(KeyError):
+    """The board session expired or never existed."""
+
+
+class BoardChanged(ValueError):
+    """The board was edited since the version a request started from."""
+
+
+def apply_edits(columns, boards, edits):
+    """
+    Apply edits to columns and boards in place.
+
+    :return: ids of the columns whose syllables changed, added or deleted
+    """
+    touched = set()
+    for edit in edits:
+        op = edit.get("op")
+        if op == "column":
+            column_id = edit["columnId"]
+            old_column = columns.get(column_id)
+            if (
+                old_column is None
+                or old_column["syllableIds"] != edit["column"]["syllableIds"]
+            ):
+                touched.add(column_id)
+            columns[column_id] = edit["column"]
+        elif op == "delete-column":
+            if columns.pop(edit["columnId"], None) is not None:
+                touched.add(edit["columnId"])
+        elif op == "board":
+            boards[edit["boardId"]] = edit["board"]
+        elif op == "delete-board":
+            boards.pop(edit["boardId"], None)
+        else:
+            raise ValueError(f"Unknown edit operation: {op}")
+    return touched
+
+
+def edited_board(board, edits):
+    """
+    Copy of board with edits applied. Only the board and its columns and boards
+    mappings are copied, so boards already handed out never change.
+    """
+    board = {
+        **board,
+        "columns": dict(board["columns"]),
+        "boards": dict(board["boards"]),
+    }
+    apply_edits(board["columns"], board["boards"], edits)
+    return board
+
+
+# Keys each edit operation needs
+EDIT_KEYS = {
+    "column": ("columnId", "column"),
+    "delete-column": ("columnId",),
+    "board": ("boardId", "board"),
+    "delete-board": ("boardId",),
+}
+
+
+def check_edits(edits):
+    """
+    Make sure edits can be applied, before they are logged.
+
+    :raises ValueError: for an unknown operation or a missing key
+    """
+    if not isinstance(edits, list):
+        raise ValueError("edits must be a list")
+    for edit in edits:
+        op = edit.get("op") if isinstance(edit, dict) else None
+        if op not in EDIT_KEYS:
+            raise ValueError(f"Unknown edit operation: {op}")
+        for key in EDIT_KEYS[op]:
+            if key not in edit:
+                raise ValueError(f"{op} edit without {key}")
+        if op == "column" and "syllableIds" not in edit["column"]:
+            raise ValueError("column edit without syllableIds")
+
+
+def patch_edits(patch):
+    """Edits applying a refish patch (see refish_session.refish_edits)."""
+    return (
+        [
+            {"op": "column", "columnId": column_id, "column": column}
+            for column_id, column in patch["columns"].items()
+        ]
+        + [
+            {"op": "board", "boardId": board_id, "board": board}
+            for board_id, board in patch["boards"].items()
+        ]
+        + [{"op": "delete-column", "columnId": i} for i in patch["deletedColumns"]]
+        + [{"op": "delete-board", "boardId": i} for i in patch["deletedBoards"]]
+    )
+
+
+class BoardStore(object):
+    """Boards by session id, in an LRU in memory over an SQLite database."""
+
+    def __init__(self, max_sessions, db_path, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.entries = OrderedDict()  # session id -> [version, board]
+        self.lock = threading.Lock()
+        self.db_path = db_path
+        self.db = None
+        self.db_pid = None
+
+    def _connect(self):
+        # An SQLite connection can't be used across fork(), so every process
+        # (e.g. each gunicorn worker after --preload) opens its own
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db_pid = os.getpid()
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS boards ("
+                "session TEXT PRIMARY KEY, version INTEGER, board TEXT, used REAL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS edits ("
+                "session TEXT, version INTEGER, edits TEXT, "
+                "PRIMARY KEY (session, version))"
+            )
+            self.db.commit()
+        return self.db
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock of the database at once, so no
+        # other worker can log an edit between reading a board and writing it
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+    def create(self, board):
+        """Store a board, returning the id of its session."""
+        session_id = uuid.uuid4().hex
+        board = {field: board[field] for field in BOARD_FIELDS}
+        with self.lock, self._transaction():
+            self._save(session_id, 0, board)
+            self._purge()
+            self._remember(session_id, [0, board])
+        return session_id
+
+    def get(self, session_id):
+        """
+        Board of a session, with every edit made so far.
+
+        :return: (version, board) where board is shared with the store and
+                 other requests, and must not be changed; the store never
+                 changes it either, edits make a new board
+        """
+        with self.lock, self._transaction():
+            version, board = self._entry(session_id)
+            return version, board
+
+    def update(self, session_id, edits):
+        """Apply edits to the board of a session, returning its new version."""
+        check_edits(edits)
+        serialized = json.dumps(edits, ensure_ascii=False)
+        with self.lock:
+            with self._transaction() as db:
+                entry = self._entry(session_id)
+                db.execute(
+                    "INSERT INTO edits VALUES (?, ?, ?)",
+                    (session_id, entry[0] + 1, serialized),
+                )
+                db.execute(
+                    "UPDATE boards SET used = ? WHERE session = ?",
+                    (time.time(), session_id),
+                )
+            # a copy of the edits, as the caller may keep changing what it logged
+            entry[1] = edited_board(entry[1], json.loads(serialized))
+            entry[0] += 1
+            return entry[0]
+
+    def replace(self, session_id, version, **fields):
+        """
+        Replace parts of the board of a session, e.g. by the board refished from
+        its given version.
+
+        :raises BoardChanged: if the board was edited since that version
+        """
+        fields = json.loads(json.dumps(fields, ensure_ascii=False))
+        with self.lock, self._transaction():
+            entry = self._entry(session_id)
+            if entry[0] != version:
+                raise BoardChanged(session_id)
+            entry[1] = {**entry[1], **fields}
+            entry[0] += 1
+            self._save(session_id, entry[0], entry[1])
+
+    def _entry(self, session_id):
+        """[version, board] of a session, brought up to date with the database."""
+        db = self._connect()
+        entry = self.entries.get(session_id)
+        if entry is None:
+            row = db.execute(
+                "SELECT version, board FROM boards WHERE session = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                raise UnknownBoard(session_id)
+            entry = [row[0], json.loads(row[1])]
+        else:
+            newer = db.execute(
+                "SELECT version FROM boards WHERE session = ? AND version > ?",
+                (session_id, entry[0]),
+            ).fetchone()
+            if newer is not None:
+                # replaced by another worker
+                self.entries.pop(session_id)
+                return self._entry(session_id)
+        logged = db.execute(
+            "SELECT version, edits FROM edits WHERE session = ? AND version > ?"
+            " ORDER BY version",
+            (session_id, entry[0]),
+        ).fetchall()
+        if logged:
+            # logged by another worker
+            entry[1] = edited_board(
+                entry[1], [edit for _, edits in logged for edit in json.loads(edits)]
+            )
+            entry[0] = logged[-1][0]
+        self._remember(session_id, entry)
+        return entry
+
+    def _remember(self, session_id, entry):
+        self.entries[session_id] = entry
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > max(self.max_sessions, 1):
+            evicted_id, (version, board) = self.entries.popitem(last=False)
+            # spill the whole board, so that reloading it replays no edits
+            self._save(evicted_id, version, board)
+
+    def _save(self, session_id, version, board):
+        db = self._connect()
+        # never overwrite a newer copy another worker wrote
+        db.execute(
+            "INSERT INTO boards VALUES (?, ?, ?, ?) ON CONFLICT (session) DO UPDATE"
+            " SET version = excluded.version, board = excluded.board,"
+            " used = excluded.used WHERE excluded.version >= boards.version",
+            (
+                session_id,
+                version,
+                json.dumps(board, ensure_ascii=False, separators=(",", ":")),
+                time.time(),
+            ),
+        )
+        db.execute(
+            "DELETE FROM edits WHERE session = ? AND version <= ?",
+            (session_id, version),
+        )
+
+    def _purge(self):
+        db = self._connect()
+        expired = time.time() - self.ttl
+        db.execute(
+            "DELETE FROM edits WHERE session IN "
+            "(SELECT session FROM boards WHERE used < ?)",
+            (expired,),
+        )
+        db.execute("DELETE FROM boards WHERE used < ?", (expired,))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+board_store = BoardStore(BOARD_STORE_SESSIONS, BOARD_STORE_DB, BOARD_STORE_TTL)
+
+
+def resolve_board(body):
+    """
+    Request body with the board of its "boardSession" filled in, after applying
+    its "boardEdits", and the version of the board as "boardVersion". Bodies
+    without a board session are returned as they are.
+
+    The board is shared with the store, apart from its columns, which are
+    copied one by one as refishing marks them in place; the rest must not be
+    changed.
+    """
+    if not body or not body.get("boardSession"):
+        return body
+    session_id = body["boardSession"]
+    if body.get("boardEdits"):
+        board_store.update(session_id, body["boardEdits"])
+    version, board = board_store.get(session_id)
+    columns = {
+        column_id: dict(column) for column_id, column in board["columns"].items()
+    }
+    return {
+        **board,
+        "columns": columns,
+        # as /compare-fst takes it
+        "board": {"columns": columns, "boards": board["boards"]},
+        "boardVersion": version,
+        **body,
+    }
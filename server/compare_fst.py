@@ -25,15 +25,15 @@ fst_index = {'Old_Burmese': 'burmese', 'Achang_Longchuan': 'ngochang', 'Xiandao'
 
 # Basic imports
 from hashlib import new
+import os
 import sys
 import re
 import json
-import csv
+import threading
 
-from numpy import equal
+import numpy as np
 from merge_phonemes import merge_phonemes
 from functools import reduce
-from collections import Counter
 from tabulate import tabulate
 
 ##### ROUTINES #####
@@ -104,23 +104,30 @@ def print_language_name(name):
 # syllable_ids: syllable_id's of the syllables in a class, as defined contra "words"
 # fsts: different sets of fst
 # words: given here in order not to abuse global variables
+# recs_of_syl: reconstructions already computed by apply_up_by_doculect, if any
 # Return values: (inferred_reconstructions, strict)
-def back_reconstruct_list(syllable_ids, fsts, words):
+def back_reconstruct_list(syllable_ids, fsts, words, recs_of_syl=None):
     reconsts = {}
     at_least_one = False
     first_form = False
 
+    syllables = []
     for syllable_id in syllable_ids:
         word_id, _, n = syllable_id.rpartition('-')
         n = int(n)
-        ipa = words[word_id]['syllables'][n]
-        doculect = words[word_id]['doculect']
-
+        syllables.append(
+            (words[word_id]['doculect'], words[word_id]['syllables'][n]))
+    if recs_of_syl is None:
+        # Reconstruct the whole list at once, with one applyer per doculect
+        recs_of_syl = apply_up_by_doculect(
+            fsts, [(doculect, replace_diacritics(ipa)) for doculect, ipa in syllables])
+
+    for doculect, ipa in syllables:
         if not first_form:
             first_form = ipa
         if doculect in fsts:
             the_syl = replace_diacritics(ipa)
-            rec = list(fsts[doculect].apply_up(the_syl))
+            rec = list(recs_of_syl[doculect][the_syl])
             if rec:
                 # only record reconstructions when something *is* reconstructed
                 at_least_one = True
@@ -133,19 +140,9 @@ def back_reconstruct_list(syllable_ids, fsts, words):
     inferred_reconstructions = []
 
     if at_least_one:
-        strict = True
-        inferred_reconstructions = list(set.intersection(*reconsts.values()))
-
-        if not inferred_reconstructions:
-            strict = False
-            # kinda lenient way of generating reconstructions
-            # try and make intersection of every pair of doculects
-            pairwise_intersections = [set.intersection(reconsts[a], reconsts[b])
-                    for a in reconsts for b in reconsts if a != b]
-            if pairwise_intersections:
-                inferred_reconstructions = list(set.union(*pairwise_intersections))
-            else:
-                inferred_reconstructions = []
+        # the intersection of all doculects, or if empty, the kinda lenient
+        # union of the intersections of every pair of doculects
+        inferred_reconstructions, strict = infer_reconstructions(reconsts.values())
 
     return (inferred_reconstructions, strict)
 
@@ -155,45 +152,46 @@ def back_reconstruct_list(syllable_ids, fsts, words):
 # eprint('Program starts')
 
 # Compile transducers
-from foma import FST
-import tempfile
-import os
-import subprocess
+from fst_cache import compile_transducer
+from apply_cache import apply_down_many, apply_up_by_doculect
+from reconstruction import infer_reconstructions
+from dataset import load_dataset
+from jobs import report_stage
 
 
-def read_transducer(input_json, old_new, errors):
+def read_transducer(script, name, errors):
     ret = {}
-    script_path = os.path.dirname(os.path.realpath(__file__))
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        os.chdir(tmpdirname)
-        eprint(f'Compiling FSTs ({old_new})')
-        with open('transducer.foma', 'w') as fp:
-            fp.write(input_json[f'{old_new}Transducer'])
-        eprint("---------")
-        output = subprocess.run(['foma', '-f', 'transducer.foma'],
-                                capture_output=True, check=True, text=True)
-
-        # Add errors from stderr
-        if (len(output.stderr) > 0):
-            for err in output.stderr.split("\n"):
-                if len(err) > 0:
-                    errors.append(f"Error loading {old_new} transducer: {err}")
-                    eprint(err)
-
-        # Check for errors in stdout, to be passed back to the program
-        if '***' in output.stdout:
-            error = f"Error loading {old_new} transducer: " + output.stdout.split('***')[1]
-            eprint(error)
-            errors.append(error)
-
-        for doculect_name in fst_index:
-            if os.path.isfile(fst_index[doculect_name] + '.bin'):
-                ret[doculect_name] = FST.load(fst_index[doculect_name] + '.bin')
-        os.chdir(script_path)
-        eprint('FSTs loaded:', ', '.join(ret))
+    eprint(f'Compiling FSTs ({name})')
+    eprint("---------")
+    networks, compile_errors = compile_transducer(script)
+
+    # Pass compiler errors back to the program
+    for err in compile_errors:
+        error = f"Error loading {name} transducer: {err}"
+        eprint(error)
+        errors.append(error)
+
+    for doculect_name in fst_index:
+        if fst_index[doculect_name] in networks:
+            ret[doculect_name] = networks[fst_index[doculect_name]]
+    eprint('FSTs loaded:', ', '.join(ret))
     return ret
 
 
+# Compile several transducers, one after the other: foma compiles under one
+# lock, and the statements a script shares with those compiled before it are
+# not compiled again (see foma_script.ScriptGraph)
+# scripts, names: the foma scripts and how to call them in errors
+# Return value: ([{doculect: FST}] in the order of scripts, errors)
+def read_transducers(scripts, names):
+    compiled = {}
+    errors = []
+    # the same script is only compiled once
+    for script in dict.fromkeys(scripts):
+        compiled[script] = read_transducer(script, names[scripts.index(script)], errors)
+    return [compiled[script] for script in scripts], errors
+
+
 def process_row(row):
     if row['ID'].startswith('#'):
         # internal to lingpy
@@ -224,39 +222,295 @@ def process_row(row):
     return {word_id: word_json}
 
 
-def compare_fst(input_json):
-    # decode the input JSON
-    # input_json = json.load(open('input-correspondence.json', 'r+'))
-
-    # First field from JSON: langsUnderStudy
-    langs_under_study = input_json['langsUnderStudy']
-
-    # Board from JSON
-    errors = []
-
-    fsts_old = read_transducer(input_json, 'old', errors)
-    fsts_new = read_transducer(input_json, 'new', errors)
+# Doculects whose networks in fsts_old and fsts_new may differ, including
+# those with a network in only one of them
+def changed_doculects(fsts_old, fsts_new):
+    changed = set()
+    for doculect in set(fsts_old) | set(fsts_new):
+        if doculect not in fsts_old or doculect not in fsts_new:
+            changed.add(doculect)
+        elif fsts_old[doculect] is fsts_new[doculect]:
+            continue
+        elif fsts_old[doculect].digest() == fsts_new[doculect].digest():
+            continue
+        # fsm_equivalent: the same relation, however it was built
+        elif fsts_old[doculect] != fsts_new[doculect]:
+            changed.add(doculect)
+    return changed
+
+
+# Forms a transducer projects reconstructions to, remembering them in projections
+def project_forward(fst, reconstructions, projections):
+    missing = [w for w in reconstructions if w not in projections]
+    if missing:
+        projections.update(apply_down_many(fst, missing))
+    fwd_recs = []
+    for w in reconstructions:
+        fwd_recs.extend(projections[w])
+    return fwd_recs
+
+
+# Among groups of rows sharing a parent key, pick for each parent the group with
+# the most rows, ties going to the group seen first (as Counter.most_common does).
+# parents, counts, firsts: one entry per group. Returns the indices of the picked
+# groups, sorted by parent.
+def pick_most_common(parents, counts, firsts):
+    order = np.lexsort((firsts, -counts, parents))
+    _, first_of_parent = np.unique(parents[order], return_index=True)
+    return order[first_of_parent]
+
+
+# Correspondence patterns of columns, computed for all of them at once
+# column_ids: the columns, in the order they are charted (may repeat)
+# Return value: for each column, a list of (position, description,
+# most_common_ipas, most_common_gloss, last_doculect_present,
+# any_non_last_doculect_present) in order of first appearance of the position
+def correspondence_patterns(column_ids, columns, words, langs_under_study):
+    # One row per (column, position, doculect, sound, ipa, gloss), with every
+    # string replaced by an integer code
+    codes = {}
+    def code(value):
+        return codes.setdefault(value, len(codes))
+    rank = {}
+    for i, doculect in enumerate(langs_under_study):
+        rank.setdefault(doculect, i)
+
+    table = []
+    for k, column_id in enumerate(column_ids):
+        for syllable_id in columns[column_id]['syllableIds']:
+            word_id, _, n = syllable_id.rpartition('-')
+            n = int(n)
+            word = words[word_id]
+            ipa = code(word['syllables'][n])
+            doculect = rank.get(word['doculect'], -1)
+            gloss = code(word['gloss'])
+            syllable_parsed = word['syllables_parsed'][n]
+            for position, sound in zip(syllable_parsed[0].split(' '), syllable_parsed[1].split(' ')):
+                table.append((k, code(position), doculect, code(sound), ipa, gloss))
+    strings = list(codes)
+    if not table:
+        return [[] for _ in column_ids]
+    col, pos, doc, sound, ipa, gloss = np.array(table, dtype=np.int64).T
+    seq = np.arange(len(col))
+    n_rows = len(seq)
+    n_codes = len(strings)
+    n_langs = len(langs_under_study)
+
+    # positions of each column, in order of appearance, whatever the doculect
+    col_pos, first = np.unique(col * n_codes + pos, return_index=True)
+    positions_of_column = [[] for _ in column_ids]
+    for key in col_pos[np.argsort(first)]:
+        positions_of_column[key // n_codes].append(key % n_codes)
+
+    # only doculects under study are charted
+    under_study = doc >= 0
+    col, pos, doc, sound, ipa, gloss, seq = (a[under_study] for a in (col, pos, doc, sound, ipa, gloss, seq))
+    if not len(col):
+        return [[(strings[p], ':'.join('-' * n_langs), ['--'] * n_langs, '?', False, False)
+                 for p in positions] for positions in positions_of_column]
+    group = (col * n_codes + pos) * n_langs + doc
+
+    # most common sound of each (column, position, doculect)
+    sound_keys, first, counts = np.unique(group * n_codes + sound, return_index=True, return_counts=True)
+    picked = pick_most_common(sound_keys // n_codes, counts, first)
+    groups = sound_keys[picked] // n_codes
+    group_sound = sound_keys[picked] % n_codes
+
+    # rows with that sound
+    has_sound = group_sound[np.searchsorted(groups, group)] == sound
+
+    # most common ipa of each (column, position, doculect) among those rows
+    ipa_keys, first, counts = np.unique(group[has_sound] * n_codes + ipa[has_sound], return_index=True, return_counts=True)
+    picked = pick_most_common(ipa_keys // n_codes, counts, first)
+    group_ipa = ipa_keys[picked] % n_codes
+
+    # most common gloss of each (column, position) among those rows, in order
+    # of the doculects under study
+    shared = group[has_sound] // n_langs
+    gloss_keys, inverse, counts = np.unique(shared * n_codes + gloss[has_sound], return_inverse=True, return_counts=True)
+    first = np.full(len(gloss_keys), np.iinfo(np.int64).max)
+    # rank of the doculect, then row number in the whole table (seq is filtered
+    # to the doculects under study, but still numbers the rows of the table)
+    np.minimum.at(first, inverse, doc[has_sound] * n_rows + seq[has_sound])
+    picked = pick_most_common(gloss_keys // n_codes, counts, first)
+    gloss_of = dict(zip((gloss_keys[picked] // n_codes).tolist(), (gloss_keys[picked] % n_codes).tolist()))
+
+    found = dict(zip(groups.tolist(), zip(group_sound.tolist(), group_ipa.tolist())))
+    patterns = []
+    for k, positions in enumerate(positions_of_column):
+        column_patterns = []
+        for p in positions:
+            description = []
+            most_common_ipas = []
+            last_doculect_present = False
+            any_non_last_doculect_present = False
+            for doculect in langs_under_study:
+                key = (k * n_codes + p) * n_langs + rank[doculect]
+                if key in found:
+                    if doculect == langs_under_study[-1]:
+                        last_doculect_present = True
+                    else:
+                        any_non_last_doculect_present = True
+                    description.append(strings[found[key][0]])
+                    most_common_ipas.append(strings[found[key][1]])
+                else:
+                    description.append('-')
+                    most_common_ipas.append('--')
+            most_common_gloss = '?'
+            if k * n_codes + p in gloss_of:
+                most_common_gloss = strings[gloss_of[k * n_codes + p]]
+            column_patterns.append((strings[p], ':'.join(description), most_common_ipas, most_common_gloss,
+                                    last_doculect_present, any_non_last_doculect_present))
+        patterns.append(column_patterns)
+    return patterns
+
+
+# Parsed lexicons: absolute path -> ((mtime, size), words)
+parsed_lexicons = {}
+parsed_lexicons_lock = threading.Lock()
+
+
+def read_lexicon(path):
+    """
+    The words of a lexicon file as built by process_row, cached until the
+    file's mtime or size changes. The result is shared, do not modify it.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with parsed_lexicons_lock:
+        cached = parsed_lexicons.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
 
+    eprint('Processing TSV rows...')
+    words = {}
+    for row in load_dataset(path).dicts():
+        words.update(process_row(row))
+    with parsed_lexicons_lock:
+        parsed_lexicons[path] = (version, words)
+    return words
+
+
+# Reconstructions of every board syllable under each version of the transducer
+# The first version is applied in full, the others only for the doculects whose
+# networks differ from it; they share its results for the rest
+# Return values: lists with one entry per version, of
+#   recs: {doculect: {syllable: reconstructions}}
+#   changed: doculects whose networks differ from the first version
+#   affected: (doculect, syllable) reconstructed differently than by the first
+#             version, i.e. the part of the board in the domain of the symmetric
+#             difference of their relations
+#   projections: {doculect: {reconstruction: forms}}, filled by project_forward
+def reconstruct_versions(versions, board_syllables):
+    baseline = versions[0]
+    recs = [apply_up_by_doculect(baseline, board_syllables)]
+    changed = [set()]
+    affected = [set()]
+    projections = [{doculect: {} for doculect in baseline}]
+    for fsts in versions[1:]:
+        version_changed = changed_doculects(baseline, fsts)
+        # doculects without syllables on the board have no entry in recs[0]
+        version_recs = {doculect: doculect_recs for doculect, doculect_recs in recs[0].items()
+                        if doculect in fsts and doculect not in version_changed}
+        version_recs.update(apply_up_by_doculect(
+            {doculect: fsts[doculect] for doculect in version_changed if doculect in fsts},
+            board_syllables))
+        eprint('Changed FSTs:', ', '.join(sorted(version_changed)))
+
+        version_affected = set()
+        for doculect, the_syl in board_syllables:
+            if doculect in version_changed:
+                old_recs = set(recs[0].get(doculect, {}).get(the_syl, ()))
+                new_recs = set(version_recs.get(doculect, {}).get(the_syl, ()))
+                if old_recs != new_recs:
+                    version_affected.add((doculect, the_syl))
+
+        recs.append(version_recs)
+        changed.append(version_changed)
+        affected.append(version_affected)
+        projections.append({doculect: projections[0][doculect]
+                            if doculect in baseline and doculect not in version_changed else {}
+                            for doculect in fsts})
+    return recs, changed, affected, projections
+
+
+# What each doculect under study reconstructs for a row, under one version
+# reconstructions: (inferred_reconstructions, strict) of the column
+# most_common_ipas: the syllable of each doculect in the row, '--' for none
+# Return values: (title, row, matched) where title is the inferred
+# reconstructions as '*a, *b' (None without any), row has one cell per
+# doculect, and matched tells whether the last doculect reconstructs to one of
+# the inferred reconstructions
+def reconstruction_row(reconstructions, most_common_ipas, fsts, recs, projections, langs_under_study):
+    title = None
+    inferred_reconstructions, strict_reconstructions = reconstructions
+    if inferred_reconstructions:
+        title = ', '.join(['*' + w for w in inferred_reconstructions])
+        if not strict_reconstructions:
+            title += '?'
+
+    row = []
+    matched = False
+    for i in range(len(langs_under_study)):
+        doculect = langs_under_study[i]
+        under_study = i == len(langs_under_study) - 1
+        rec = []
+        if doculect in fsts and most_common_ipas[i] != '--':
+            the_syl = replace_diacritics(most_common_ipas[i])
+            rec = list(set(recs[doculect][the_syl]))
+
+        if rec:
+            rec_strs = []
+            for w in rec:
+                if w in inferred_reconstructions:
+                    rec_strs.append(r'_*' + w + '_')
+                    if under_study:
+                        matched = True
+                else:
+                    rec_strs.append('*' + w)
+            rec_str = ', '.join(rec_strs)
+            row.append(rec_str)
+        else:
+            row.append('')
+            if doculect in fsts and inferred_reconstructions and under_study:
+                # forward projection for the language under study
+                fwd_recs = project_forward(fsts[doculect], inferred_reconstructions,
+                                           projections[doculect])
+                fwd_recs = [replace_diacritics_forward(w) for w in set(fwd_recs)]
+                row[-1] = r'≠ †%s' % (', '.join(fwd_recs))
+    return title, row, matched
+
+
+# Records of the comparison of several versions of the transducer, in the order
+# they are computed: first a header
+# {'type': 'header', 'missing_transducers': [...], 'errors': [...]}, then one
+# {'type': 'section', 'chapter': 'i'|'m'|'r'|'t', 'title': ..., 'rows': [...]}
+# per correspondence pattern, chapter by chapter. Each row has the 'gloss' and
+# 'ipas' of the row, and per version (in the order of scripts) the
+# 'reconstruction' title (None without any), the 'reconstructions' of each
+# doculect and whether the last doculect 'matched' them
+# scripts, names: the foma scripts and how to call them in errors
+def compare_versions_records(langs_under_study, scripts, names, input_board):
+    report_stage('compiling')
+    versions, errors = read_transducers(scripts, names)
+
+    # Languages that no version has a transducer for are left out
     both_missing = []
-    if not all(b in fsts_new for b in langs_under_study) and not all(b in fsts_old for b in langs_under_study):
-        old_missing = set(langs_under_study).difference(fsts_old)
-        new_missing = set(langs_under_study).difference(fsts_new)
-        eprint('Missing old FST for languages:', ', '.join(old_missing))
-        eprint('Missing new FST for languages:', ', '.join(new_missing))
-        both_missing = list((old_missing) & (new_missing))
+    if not any(all(b in fsts for b in langs_under_study) for fsts in versions):
+        missing = [set(langs_under_study).difference(fsts) for fsts in versions]
+        for name, version_missing in zip(names, missing):
+            eprint(f'Missing {name} FST for languages:', ', '.join(version_missing))
+        both_missing = list(set.intersection(*missing))
         langs_under_study = [lang for lang in langs_under_study if lang not in both_missing]
 
-    # read the word CSV
-    # import fileinput
-    csvreader = csv.DictReader(filter(lambda row: row.strip() and row[0]!='#', open('./lexicon.tsv', 'r')), dialect='excel-tab')
+    yield {'type': 'header', 'missing_transducers': both_missing, 'errors': errors}
 
-    eprint('Processing TSV rows...')
-    words = {}
-    for row in csvreader:
-        words.update(process_row(row))
+    # read the word CSV (parsed once per version of the file)
+    report_stage('reconstructing')
+    words = read_lexicon('./lexicon.tsv')
 
     eprint('Processing boards...')
-    input_board = input_json['board']
 
     columns = input_board['columns']
     boards = input_board['boards']
@@ -268,208 +522,149 @@ def compare_fst(input_json):
     # column_index['i']['p:p:p'] -> [...]
     column_index = {pos:{} for pos in 'imrt'}
 
+    # One reconstruction pass per transducer over every syllable on the board,
+    # the columns, chapters and rows below only look the results up
+    board_syllables = []
+    for board_id in boards:
+        for column_id in boards[board_id]['columnIds']:
+            for syllable_id in columns[column_id]['syllableIds']:
+                word_id, _, n = syllable_id.rpartition('-')
+                board_syllables.append((words[word_id]['doculect'],
+                                        replace_diacritics(words[word_id]['syllables'][int(n)])))
+    recs, changed, affected, projections = reconstruct_versions(versions, board_syllables)
+
+    # Correspondences of every column of the board, counted together
+    charted_columns = [column_id for board_id in boards for column_id in boards[board_id]['columnIds']
+                       if columns[column_id]['syllableIds']]
+    patterns = iter(correspondence_patterns(charted_columns, columns, words, langs_under_study))
+
     for board_id in boards:
         for column_id in boards[board_id]['columnIds']:
             if not columns[column_id]['syllableIds']:
                 continue
 
-            # First, guess the reconstruction
+            # First, guess the reconstruction, once per transducer
             # print(columns, flush=True)
             print('id', column_id, flush=True)
-            print('words', len(words), flush=True)
-            print('words', words, flush=True)
-            inferred_reconstructions, strict_reconstructions = back_reconstruct_list(columns[column_id]['syllableIds'], fsts_old, words)
-
-            # cnt[pos][doculect] → Counter of possibilities
-            cnt = {}
-            sylls = {}
-            senses = {}
-
-            for syllable_id in columns[column_id]['syllableIds']:
-                word_id, _, n = syllable_id.rpartition('-')
-                n = int(n)
-
-                ipa = words[word_id]['syllables'][n]
-                doculect = words[word_id]['doculect']
-                gloss = words[word_id]['gloss']
-                syllable_parsed = words[word_id]['syllables_parsed'][n]
-                syllable_fields = list(zip(syllable_parsed[0].split(' '), syllable_parsed[1].split(' ')))
-
-                for position, sound in syllable_fields:
-                    if position not in cnt:
-                        cnt[position] = {}
-                        sylls[position] = {}
-                        senses[position] = {}
-                    if doculect not in cnt[position]:
-                        cnt[position][doculect] = Counter()
-                        sylls[position][doculect] = {}
-                        senses[position][doculect] = {}
-                    if sound not in sylls[position][doculect]:
-                        sylls[position][doculect][sound] = []
-                        senses[position][doculect][sound] = []
-                    cnt[position][doculect][sound] += 1
-                    sylls[position][doculect][sound].append(ipa)
-                    senses[position][doculect][sound].append(gloss)
-
-            for position in cnt:
-                # generate the information needed for displaying a corr. chart
-                description = []
-                most_common_ipas = []
-                shared_senses = []
-
-                # Some flags that impact display
-                last_doculect_present = False
-                any_non_last_doculect_present = False
-
-                for doculect in langs_under_study:
-                    if doculect in cnt[position]:
-                        if doculect == langs_under_study[-1]:
-                            last_doculect_present = True
-                        else:
-                            any_non_last_doculect_present = True
-
-                        most_common_sound = cnt[position][doculect].most_common()[0][0]
-                        most_common_ipa = Counter(sylls[position][doculect][most_common_sound]).most_common()[0][0]
-                        description.append(most_common_sound)
-                        most_common_ipas.append(most_common_ipa)
-                        shared_senses.extend(senses[position][doculect][most_common_sound])
-                    else:
-                        description.append('-')
-                        most_common_ipas.append('--')
-                description = ':'.join(description)
-
-                most_common_gloss = '?'
-                if shared_senses:
-                    most_common_gloss = Counter(shared_senses).most_common()[0][0]
+            fst_reconstructions = [back_reconstruct_list(columns[column_id]['syllableIds'], versions[0], words, recs[0])]
+            column_affected = [False]
+            for k in range(1, len(versions)):
+                column_affected.append(False)
+                for syllable_id in columns[column_id]['syllableIds']:
+                    word_id, _, n = syllable_id.rpartition('-')
+                    the_syl = replace_diacritics(words[word_id]['syllables'][int(n)])
+                    if (words[word_id]['doculect'], the_syl) in affected[k]:
+                        column_affected[k] = True
+                        break
+                if column_affected[k]:
+                    fst_reconstructions.append(back_reconstruct_list(columns[column_id]['syllableIds'], versions[k], words, recs[k]))
+                else:
+                    # every syllable reconstructs as before, so does the column
+                    fst_reconstructions.append(fst_reconstructions[0])
 
+            for position, description, most_common_ipas, most_common_gloss, \
+                    last_doculect_present, any_non_last_doculect_present in next(patterns):
                 column_info = {'column_id': column_id,
                         'most_common_gloss': most_common_gloss,
                         'most_common_ipas': most_common_ipas,
                         'last_doculect_present': last_doculect_present,
                         'any_non_last_doculect_present': any_non_last_doculect_present,
-                        'old_fst_reconstructions': (inferred_reconstructions, strict_reconstructions),
-                        'new_fst_reconstructions': back_reconstruct_list(columns[column_id]['syllableIds'], fsts_new, words)}
+                        'fst_reconstructions': fst_reconstructions,
+                        'affected': column_affected}
                 if description not in column_index[position]:
                     column_index[position][description] = []
                 column_index[position][description].append(column_info)
 
-    text = ''
-
     pos_name = {'i': 'Initial', 'm': 'Medial', 'r': 'Rime', 't': 'Tone'}
-    json_chapters = {}
 
+    report_stage('grouping')
     for pos in column_index:
-        text += '=====' + pos_name[pos] + ' Correspondence =====\n'
-        json_chapters[pos] = []
         for description in sorted(column_index[pos]):
             if not column_index[pos][description] or not column_index[pos][description][0]['last_doculect_present'] or not column_index[pos][description][0]['any_non_last_doculect_present']:
                 continue
 
-            text += "=== %s: %s ===\n" % (pos_name[pos], description)
-
-            this_section = {'title': "=== %s: %s ===\n" % (pos_name[pos], description)}
             rows = []
 
             for column in column_index[pos][description]:
-                this_row = {}
-
-                # first row: gloss & IPA's
-                this_row['gloss'] = column['most_common_gloss']
-                this_row['ipas'] = column['most_common_ipas']
-
-                # second row: old reconstructions
-                row = []
-                inferred_reconstructions, strict_reconstructions = column['old_fst_reconstructions']
-                if inferred_reconstructions:
-                    rec_str = ', '.join(['*' + w for w in inferred_reconstructions])
-                    if not strict_reconstructions:
-                        rec_str += '?'
-                    this_row['old_reconstruction'] = rec_str
-                
-                old_reconstruction_matched = False
-                new_reconstruction_matched = False
-
-                for i in range(len(langs_under_study)):
-                    doculect = langs_under_study[i]
-                    under_study = i == len(langs_under_study) - 1
-                    rec = []
-                    if doculect in fsts_old and column['most_common_ipas'][i] != '--':
-                        the_syl = replace_diacritics(column['most_common_ipas'][i])
-                        rec = list(set(fsts_old[doculect].apply_up(the_syl)))
-
-                    if rec:
-                        rec_strs = []
-                        for w in rec:
-                            if w in inferred_reconstructions:
-                                rec_strs.append(r'_*' + w + '_')
-                                if under_study:
-                                    old_reconstruction_matched = True
-                            else:
-                                rec_strs.append('*' + w)
-                        rec_str = ', '.join(rec_strs)
-                        row.append(rec_str)
-                    else:
-                        row.append('')
-                        if doculect in fsts_old and inferred_reconstructions and i == len(langs_under_study) - 1:
-                            # forward projection for the language under study
-                            fwd_recs = []
-                            for w in inferred_reconstructions:
-                                fwd_recs.extend(list(fsts_old[doculect].apply_down(w)))
-                            fwd_recs = [replace_diacritics_forward(w) for w in set(fwd_recs)]
-                            row[-1] = r'≠ †%s' % (', '.join(fwd_recs))
-
-                this_row['old_reconstructions'] = row
-
-                # third row: new reconstructions
-                row = []
-                inferred_reconstructions, strict_reconstructions = column['new_fst_reconstructions']
-                if inferred_reconstructions:
-                    rec_str = ', '.join(['*' + w for w in inferred_reconstructions])
-                    if not strict_reconstructions:
-                        rec_str += '?'
-                    this_row['new_reconstruction'] = rec_str
-                
-                for i in range(len(langs_under_study)):
-                    doculect = langs_under_study[i]
-                    under_study = i == len(langs_under_study) - 1
-                    rec = []
-                    if doculect in fsts_new and column['most_common_ipas'][i] != '--':
-                        the_syl = replace_diacritics(column['most_common_ipas'][i])
-                        rec = list(set(fsts_new[doculect].apply_up(the_syl)))
-
-                    if rec:
-                        rec_strs = []
-                        for w in rec:
-                            if w in inferred_reconstructions:
-                                rec_strs.append(r'_*' + w + '_')
-                                if i == len(langs_under_study) - 1:
-                                    new_reconstruction_matched = True
-                            else:
-                                rec_strs.append('*' + w)
-                        rec_str = ', '.join(rec_strs)
-                        row.append(rec_str)
+                this_row = {'gloss': column['most_common_gloss'],
+                            'ipas': column['most_common_ipas'],
+                            'reconstruction': [],
+                            'reconstructions': [],
+                            'matched': []}
+                for k in range(len(versions)):
+                    if k and not column['affected'][k] and langs_under_study[-1] not in changed[k]:
+                        # same reconstructions and projections as the first version
+                        title, row, matched = this_row['reconstruction'][0], this_row['reconstructions'][0], this_row['matched'][0]
                     else:
-                        row.append('')
-                        if doculect in fsts_new and inferred_reconstructions and i == len(langs_under_study) - 1:
-                            # forward projection for the language under study
-                            fwd_recs = []
-                            for w in inferred_reconstructions:
-                                fwd_recs.extend(list(fsts_new[doculect].apply_down(w)))
-                            fwd_recs = [replace_diacritics_forward(w) for w in set(fwd_recs)]
-                            row[-1] = r'≠ †%s' % (', '.join(fwd_recs))
-
-                this_row['new_reconstructions'] = row
-
-                this_row['status'] = ''
-                if old_reconstruction_matched and not new_reconstruction_matched:
-                    this_row['status'] = 'frowning'
-                elif (not old_reconstruction_matched) and new_reconstruction_matched:
-                    this_row['status'] = 'smiling'
-
+                        title, row, matched = reconstruction_row(column['fst_reconstructions'][k], column['most_common_ipas'],
+                                                                 versions[k], recs[k], projections[k], langs_under_study)
+                    this_row['reconstruction'].append(title)
+                    this_row['reconstructions'].append(row)
+                    this_row['matched'].append(matched)
                 rows.append(this_row)
 
-            this_section['rows'] = rows
-            json_chapters[pos].append(this_section)
+            yield {'type': 'section', 'chapter': pos,
+                   'title': "=== %s: %s ===\n" % (pos_name[pos], description), 'rows': rows}
 
     eprint("Successful comparison.")
-    return {'chapters': json_chapters, 'missing_transducers': both_missing, 'errors': errors}
+
+
+# Records of the comparison of the old and new transducers, as
+# compare_versions_records, with rows as the FST comparator shows them
+def compare_fst_records(input_json):
+    records = compare_versions_records(input_json['langsUnderStudy'],
+                                       [input_json['oldTransducer'], input_json['newTransducer']],
+                                       ['old', 'new'], input_json['board'])
+    for record in records:
+        if record['type'] == 'section':
+            record['rows'] = [old_new_row(row) for row in record['rows']]
+        yield record
+
+
+def old_new_row(row):
+    this_row = {'gloss': row['gloss'], 'ipas': row['ipas']}
+    old_title, new_title = row['reconstruction']
+    if old_title is not None:
+        this_row['old_reconstruction'] = old_title
+    this_row['old_reconstructions'] = row['reconstructions'][0]
+    if new_title is not None:
+        this_row['new_reconstruction'] = new_title
+    this_row['new_reconstructions'] = list(row['reconstructions'][1])
+
+    old_reconstruction_matched, new_reconstruction_matched = row['matched']
+    this_row['status'] = ''
+    if old_reconstruction_matched and not new_reconstruction_matched:
+        this_row['status'] = 'frowning'
+    elif (not old_reconstruction_matched) and new_reconstruction_matched:
+        this_row['status'] = 'smiling'
+    return this_row
+
+
+# Gather the records of a comparison into one JSON object
+def collect_records(records):
+    result = {'chapters': {pos: [] for pos in 'imrt'}}
+    for record in records:
+        if record['type'] == 'header':
+            result['missing_transducers'] = record['missing_transducers']
+            result['errors'] = record['errors']
+        else:
+            result['chapters'][record['chapter']].append({'title': record['title'],
+                                                          'rows': record['rows']})
+    return result
+
+
+# The whole comparison as one JSON object
+def compare_fst(input_json):
+    return collect_records(compare_fst_records(input_json))
+
+
+# Records of the comparison of a list of transducers (input_json['transducers'])
+def compare_fsts_records(input_json):
+    scripts = input_json['transducers']
+    names = ['#%d' % (k + 1) for k in range(len(scripts))]
+    return compare_versions_records(input_json['langsUnderStudy'], scripts, names, input_json['board'])
+
+
+# The whole comparison of a list of transducers as one JSON object
+def compare_fsts(input_json):
+    return collect_records(compare_fsts_records(input_json))
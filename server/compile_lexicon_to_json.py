@@ -5,17 +5,17 @@
 
 # Basic imports
 import os
-import subprocess
 import sys
 import re
-import csv
 import json
 from functools import reduce
-import tempfile
 from disjointset import DisjointSet
 from foma import FST
+from fst_cache import compile_transducer
+from apply_cache import apply_up_by_doculect, apply_down_many
+from reconstruction import infer_reconstructions
+from dataset import DATASET_COLUMNS, load_dataset
 import argparse
-import fileinput
 from collections import defaultdict
 
 
@@ -40,6 +40,21 @@ def replace_diacritics_down(s):
     return s.replace("_", UNICODE_MACRON_UNDER).replace("~", UNICODE_TILDE_OVER)
 
 
+# Convert a syllable from the TOKENS column to what the transducers expect
+def transducer_form(word, pipeline_name):
+    # Make the current syllable equal to the whole word, since we are
+    # working with the Germanic data. Also add spaces so that Mattis'
+    # transducer will work.
+    # Bad stuff because of how current germanic FST is written
+    if pipeline_name == "germanic":
+        syl = word.replace(".", " ") + " "
+    else:
+        syl = word.replace(".", "")
+
+    # for burmish?
+    return replace_diacritics_up(syl)
+
+
 # Convert a piece of text to its component syllables
 # If there is already "◦" or a space, use it to separate them
 # Otherwise, separate the tone letters other letters
@@ -173,6 +188,23 @@ def sort_row_tuples(row_tuples, reconstructed_sense):
     return row_tuples_sorted_by_senses
 
 
+def read_transducer(pipeline_name, transducer, fst_path="/usr/app/refishing-fst.txt"):
+    """
+    Text of the transducer to run on a pipeline's data: the transducer itself,
+    or for "internal" the pipeline's file in /fsts if there is one, else fst_path.
+    """
+    if transducer != "internal":
+        return transducer
+
+    # try and access the pipeline file in /fsts
+    if os.path.isfile(f"/usr/app/fsts/{pipeline_name}.txt"):
+        fst_path = f"/usr/app/fsts/{pipeline_name}.txt"
+        eprint(f"Found input transducer for {pipeline_name}",)
+
+    with open(fst_path, encoding="utf-8") as fst_file:
+        return fst_file.read()
+
+
 def compile_to_json_full_cognates(
     path,
     transducer="internal",
@@ -199,26 +231,19 @@ def compile_to_json_full_cognates(
     # Finding file path
     path = os.path.join('/usr/app/data', path)
 
-    # Where we will put everything we read from the input data
-    data = []
-
+    # Stream the input data into columns
     # For some reason, Python sometimes can't find this file...
-    with open(os.path.abspath(path)) as f:
-        for row in f.readlines():
-            data += [[cell.strip() for cell in row.split("\t")]]
+    dataset = load_dataset(os.path.abspath(path), DATASET_COLUMNS + (cognates,))
 
-    f.close()
+    # Rows by ID, where a repeated ID takes the values of its last row
+    row_of_id = {}
+    for row, row_id in enumerate(dataset.column("ID")):
+        row_of_id[row_id] = row
 
-    header = [row for row in data if row[0] and not row[0].startswith("#")][0]
-    data_dict = {}
-    for i, row in enumerate(data[1:]):
-        if row[0].startswith("#") or not row[0].strip():
-            pass
-        else:
-            cell_dict = dict(zip(header, row))
-            data_dict[cell_dict["ID"]] = cell_dict
     # create the board dictionary
-    doculects = sorted(set([row["DOCULECT"] for row in data_dict.values()]))
+    doculects = sorted(
+        set(dataset.value(row, "DOCULECT") for row in row_of_id.values())
+    )
     boards = {
         "fstDoculects": doculects,
         "fstUp": {d: {} for d in doculects},
@@ -229,17 +254,18 @@ def compile_to_json_full_cognates(
         "syllables": {},
     }
 
-    # fill data with content by iterating over the data_dict
-    for i, row in data_dict.items():
+    # fill data with content by iterating over the rows
+    for i, row in row_of_id.items():
         idx = "word-" + str(i)
+        tokens = dataset.value(row, "TOKENS")
         boards["words"][idx] = {
             "id": idx,
-            "doculect": row["DOCULECT"],
-            # "syllables": [".".join(row["TOKENS"].split())],
-            "syllables": [".".join(r.split(" ")) for r in row["TOKENS"].split(" + ")],
+            "doculect": dataset.value(row, "DOCULECT"),
+            # "syllables": [".".join(tokens.split())],
+            "syllables": [".".join(r.split(" ")) for r in tokens.split(" + ")],
             # "syllables": syllabize(row["IPA"]),
-            "gloss": row["CONCEPT"],
-            "glossid": row["GLOSSID"],
+            "gloss": dataset.value(row, "CONCEPT"),
+            "glossid": dataset.value(row, "GLOSSID"),
         }
 
 
@@ -248,7 +274,7 @@ def compile_to_json_full_cognates(
             syl_id = "-".join([idx, str(syl_idx)])
             boards["syllables"][syl_id] = {
                 "id": syl_id,
-                "doculect": row["DOCULECT"],
+                "doculect": boards["words"][idx]["doculect"],
                 "syllables": boards["words"][idx]["syllables"],
                 "gloss": boards["words"][idx]["gloss"],
                 "glossid": boards["words"][idx]["glossid"],
@@ -259,7 +285,7 @@ def compile_to_json_full_cognates(
 
             # eprint(syllable_ids)
             # column ids are in fact the cognate sets
-            cogid = "column-" + row[cognates].split(" ")[syl_idx]
+            cogid = "column-" + dataset.value(row, cognates).split(" ")[syl_idx]
             if cogid in boards["columns"]:
                 boards["columns"][cogid]["syllableIds"].append(syl_id)
             else:
@@ -271,53 +297,33 @@ def compile_to_json_full_cognates(
     # Now we start working with the transducers
 
     fsts = {}
-    new_transducer = ""
-
-    if transducer == "internal":
-        # try and access the pipeline file in /fsts
-        if os.path.isfile(f"/usr/app/fsts/{pipeline_name}.txt"):
-            fst_path = f"/usr/app/fsts/{pipeline_name}.txt"
-            eprint(f"Found input transducer for {pipeline_name}",)
+    new_transducer = read_transducer(pipeline_name, transducer, fst_path)
 
-        with open(fst_path, encoding="utf-8") as fst_file:
-            new_transducer = fst_file.read()
-    else:
-        new_transducer = transducer
-
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        os.chdir(tmpdirname)
-        eprint("Compiling FSTs (new)")
-        with open("transducer.foma", "w", encoding="utf-8") as fp:
-            fp.write(new_transducer)
-        output = subprocess.check_output(["foma", "-f", "transducer.foma"]).decode(
-            "UTF-8"
-        )
-        eprint("\n".join(output.split("\n")[-5:]))
-        
-        # debug
-        eprint(boards["fstDoculects"])
+    eprint("Compiling FSTs (new)")
+    networks, _ = compile_transducer(new_transducer)
 
-        for doculect_name in boards["fstDoculects"]:
-            if os.path.isfile(doculect_name.lower() + ".bin"):
-                fsts[doculect_name] = FST.load(doculect_name.lower() + ".bin")
-        eprint(fsts)
-        eprint("FSTs loaded:", ", ".join(fsts))
+    # debug
+    eprint(boards["fstDoculects"])
 
+    for doculect_name in boards["fstDoculects"]:
+        if doculect_name.lower() in networks:
+            fsts[doculect_name] = networks[doculect_name.lower()]
+    eprint(fsts)
+    eprint("FSTs loaded:", ", ".join(fsts))
 
-    # Will hold something, TBD
-    ds = DisjointSet()
 
     # For each cogid, we will create a list of the cognates to be transduced
-    # Where it is a tuple of the cognate itself, plus the associated row in the data
+    # Where it is a tuple of the cognate itself, plus the doculect of its row
     rows_of_cognates = {}
 
     # Loop over each CROSSID (our cognates here) and add the relevant words
-    for i, entry in data_dict.items():
+    for i, row in row_of_id.items():
         idx = "word-" + str(i)
-        cogids_list = entry[cognates].split(" ")
+        doculect = boards["words"][idx]["doculect"]
+        cogids_list = dataset.value(row, cognates).split(" ")
 
         # now we pretend to always be working with morphemes
-        # eprint(cogids_list, entry)
+        # eprint(cogids_list, doculect)
 
         # Now we're just making a list of all the syllables/morphemes
         for syl, _ in enumerate(cogids_list):
@@ -325,15 +331,35 @@ def compile_to_json_full_cognates(
 
             if not morph_cogid in rows_of_cognates:
                 rows_of_cognates[morph_cogid] = [
-                    (boards["words"][idx]["syllables"][syl], entry)
+                    (boards["words"][idx]["syllables"][syl], doculect)
                 ]
             else:
                 rows_of_cognates[morph_cogid].append(
-                    (boards["words"][idx]["syllables"][syl], entry)
+                    (boards["words"][idx]["syllables"][syl], doculect)
                 )
         
             # eprint(rows_of_cognates[morph_cogid])
 
+    # First phase: reconstruct every distinct (doculect, form) pair once,
+    # building the syllable → reconstructions table of each doculect in one pass
+    recs_of_form = apply_up_by_doculect(
+        fsts,
+        [
+            (doculect, transducer_form(word, pipeline_name))
+            for cogs in rows_of_cognates.values()
+            for word, doculect in cogs
+        ],
+    )
+    recs_of_word = {}  # (doculect, word) -> set of reconstructions
+    for cogs in rows_of_cognates.values():
+        for word, doculect in cogs:
+            if doculect in fsts and (doculect, word) not in recs_of_word:
+                syl = transducer_form(word, pipeline_name)
+                recs = set(recs_of_form[doculect][syl])
+                recs_of_word[(doculect, word)] = recs
+
+                # Add the reconstructions to our record, whether or not they exist
+                boards["fstUp"][doculect][word] = sorted(recs)
 
     # TBD what this stuff does
     reconstructions_of_crossid = {}
@@ -344,7 +370,13 @@ def compile_to_json_full_cognates(
     included_in_clean = set([])
     # ---
 
-    # Now go through each cogid we've collected to actually start running transducers
+    # ds holds the merging relationship of cogids, merged holds the pairs of
+    # ids of cogids sharing a reconstruction
+    ds = DisjointSet(rows_of_cognates)
+    merged = []
+
+    # Second phase: go through each cogid we've collected, looking up the
+    # reconstructions of its words
     for cogid, cogs in rows_of_cognates.items():
         # First, try to guess the reconstruction by the following rule:
         # 1. Collect all reconstructions for each language
@@ -358,7 +390,7 @@ def compile_to_json_full_cognates(
         # eprint(cogs)
 
         # For each word (with Burmish would be syllable) that shares a cogid/crossid
-        for word, row in cogs:
+        for word, doculect in cogs:
             # eprint(word, cogs)
 
             if not first_form:
@@ -366,30 +398,8 @@ def compile_to_json_full_cognates(
                 pass
 
             # If we have a transducer for this doculect
-            if row["DOCULECT"] in fsts:
-                # Make the current syllable equal to the whole word, since we are
-                # working with the Germanic data. Also add spaces so that Mattis'
-                # transducer will work.
-                syl = word
-
-                # Bad stuff because of how current germanic FST is written 
-                if pipeline_name == "germanic":
-                    syl = word.replace(".", " ") + " "
-                else:
-                    syl = word.replace(".", "")
-
-                # for burmish?
-                syl = replace_diacritics_up(syl)
-
-                # print("trying ", row["DOCULECT"], " on ", syl, " : ", row["CONCEPT"])
-
-                # Apply the transducer upwards to this word
-                recs = list(fsts[row["DOCULECT"]].apply_up(syl))
-
-                # eprint(recs)
-
-                # Add the reconstructions to our record, whether or not they exist
-                boards["fstUp"][row["DOCULECT"]][word] = sorted(set(recs))
+            if doculect in fsts:
+                recs = recs_of_word[(doculect, word)]
 
                 # TBD
                 # attested_reconstructions.update(rec)
@@ -397,13 +407,13 @@ def compile_to_json_full_cognates(
                 # Only worry about reconstructions when we have actually made one
                 if len(recs) > 0:
                     at_least_one = True
-                    if row["DOCULECT"] not in reconstructions:
-                        reconstructions[row["DOCULECT"]] = set(recs)
-                        # print(row["DOCULECT"], recs)
+                    if doculect not in reconstructions:
+                        reconstructions[doculect] = set(recs)
+                        # print(doculect, recs)
                     else:
-                        reconstructions[row["DOCULECT"]] = reconstructions[
-                            row["DOCULECT"]
-                        ].union(set(recs))
+                        reconstructions[doculect] = reconstructions[doculect].union(
+                            set(recs)
+                        )
 
         strict = True  # usage TBD
 
@@ -412,24 +422,13 @@ def compile_to_json_full_cognates(
 
         # If we have at least one reconstruction made (so we can make a board?)
         if at_least_one:
-            strict = True
-            cognate_reconstructions = list(set.intersection(*reconstructions.values()))
-
-            if not cognate_reconstructions:
-                strict = False
-                # kinda lenient way of generating reconstructions
-                # try and make intersection of every pair of doculects
-                pairwise_intersections = [
-                    set.intersection(reconstructions[a], reconstructions[b])
-                    for a in reconstructions
-                    for b in reconstructions
-                    if a != b
-                ]
-                if pairwise_intersections:
-                    cognate_reconstructions = list(set.union(*pairwise_intersections))
-                else:
-                    cognate_reconstructions = []
+            # the intersection of all doculects, or if empty, the kinda lenient
+            # union of the intersections of every pair of doculects
+            cognate_reconstructions, strict = infer_reconstructions(
+                reconstructions.values()
+            )
 
+            if not strict:
                 cognate_reconstructions = ["*" + w for w in cognate_reconstructions]
 
             # print(cognate_reconstructions)
@@ -447,12 +446,11 @@ def compile_to_json_full_cognates(
             sortkey_of_crossid[cogid] = (1, str(first_form))
 
         # merge with disjoint sets
-        ds.add(cogid, cogid)
         for reconst in cognate_reconstructions:
             if reconst not in first_crossid_of_reconstruction:
-                first_crossid_of_reconstruction[reconst] = cogid
+                first_crossid_of_reconstruction[reconst] = ds.id(cogid)
             else:
-                ds.add(first_crossid_of_reconstruction[reconst], cogid)
+                merged.append((first_crossid_of_reconstruction[reconst], ds.id(cogid)))
 
         # Only output items when the reconstruction is reliable, i.e.
         # reconstruction present and based on more than one language, are printed
@@ -460,9 +458,9 @@ def compile_to_json_full_cognates(
         if cognate_reconstructions and len(reconstructions) > 1:
             included_in_clean.add(cogid)
 
-    display_crossids = sorted(
-        ds.group.keys(), key=lambda cogid: sortkey_of_crossid[cogid]
-    )
+    ds.union_many(merged)
+    groups = ds.groups()
+    display_crossids = sorted(groups, key=lambda cogid: sortkey_of_crossid[cogid])
 
     # print(display_crossids)
 
@@ -471,7 +469,7 @@ def compile_to_json_full_cognates(
     # Second round: print the actual content from display_crossids
     for major_crossid in display_crossids:
         # get crossids sharing the same reconstruction
-        crossids = sorted(ds.group[major_crossid])
+        crossids = sorted(groups[major_crossid])
 
         # get reconstructions and strictness
         strict = all([strictness_of_crossid[crossid] for crossid in crossids])
@@ -485,20 +483,8 @@ def compile_to_json_full_cognates(
         all_reconstructions = [
             set(reconstructions_of_crossid[crossid]) for crossid in crossids
         ]
-        reconstructions = list(set.intersection(*all_reconstructions))
-
-        if not reconstructions:
-            strict = False
-            pairwise_intersections = [
-                set.intersection(all_reconstructions[a], all_reconstructions[b])
-                for a in range(len(all_reconstructions))
-                for b in range(len(all_reconstructions))
-                if a != b
-            ]
-            if pairwise_intersections:
-                reconstructions = list(set.union(*pairwise_intersections))
-            else:
-                reconstructions = []
+        reconstructions, strict_title = infer_reconstructions(all_reconstructions)
+        strict = strict and strict_title
 
         board_id = "board-" + str(boardid_cntr)
         boardid_cntr += 1
@@ -551,14 +537,8 @@ def compile_to_json(filepath):
     json_fst_up = {fst: {} for fst in fsts}
     json_fst_down = {fst: {} for fst in fsts}
 
-    # Use fileinput to imitate standard UNIX utility behaviour
-    csvreader = csv.DictReader(
-        filter(
-            lambda row: row.strip() and row[0] != "#",
-            fileinput.input(files=filepath, mode="r"),
-        ),
-        dialect="excel-tab",
-    )
+    # Stream the TSV into columns, rows are then read back one at a time
+    dataset = load_dataset(filepath)
 
     # rootid/crossid correspondence
     rows_of_crossid = {}  # dictionary of arrays of duples: syllable index, row
@@ -574,11 +554,24 @@ def compile_to_json(filepath):
     included_in_clean = set([])
 
     eprint("Processing TSV rows...")
-    for row in csvreader:
+    for row in dataset.dicts():
         process_row(row, json_words, json_syllables, rows_of_crossid)
 
-    # ds holds the merging relationship of crossids
-    ds = DisjointSet()
+    # Build the syllable → reconstructions table of every doculect in one
+    # pass, the lookups below then come from the apply cache
+    apply_up_by_doculect(
+        fsts,
+        [
+            (row["DOCULECT"], replace_diacritics_up(fetch_syllable(row["IPA"], syl)))
+            for row_tuples in rows_of_crossid.values()
+            for syl, row in row_tuples
+        ],
+    )
+
+    # ds holds the merging relationship of crossids, merged holds the pairs of
+    # ids of crossids sharing a reconstruction
+    ds = DisjointSet(rows_of_crossid)
+    merged = []
 
     # pylint: disable=consider-using-dict-items
     for crossid in rows_of_crossid.keys():
@@ -591,6 +584,18 @@ def compile_to_json(filepath):
 
         json_syllableids = []
 
+        # Reconstruct the whole crossid at once, with one applyer per doculect
+        recs_of_syl = apply_up_by_doculect(
+            fsts,
+            [
+                (
+                    row["DOCULECT"],
+                    replace_diacritics_up(fetch_syllable(row["IPA"], syl)),
+                )
+                for syl, row in rows_of_crossid[crossid]
+            ],
+        )
+
         for syl, row in sort_row_tuples(rows_of_crossid[crossid], ""):
             json_syllableids.append("word-" + row["ID"] + "-" + str(syl))
 
@@ -598,7 +603,7 @@ def compile_to_json(filepath):
                 first_form = fetch_syllable(row["IPA"], syl)
             if row["DOCULECT"] in fsts:
                 the_syl = replace_diacritics_up(fetch_syllable(row["IPA"], syl))
-                rec = list(fsts[row["DOCULECT"]].apply_up(the_syl))
+                rec = list(recs_of_syl[row["DOCULECT"]][the_syl])
 
                 json_fst_up[row["DOCULECT"]][the_syl] = sorted(set(rec))
                 attested_reconstructions.update(rec)
@@ -617,23 +622,9 @@ def compile_to_json(filepath):
         crossid_reconstructions = []
 
         if at_least_one:
-            strict = True
-            crossid_reconstructions = list(set.intersection(*reconsts.values()))
-
-            if not crossid_reconstructions:
-                strict = False
-                # kinda lenient way of generating reconstructions
-                # try and make intersection of every pair of doculects
-                pairwise_intersections = [
-                    set.intersection(reconsts[a], reconsts[b])
-                    for a in reconsts
-                    for b in reconsts
-                    if a != b
-                ]
-                if pairwise_intersections:
-                    crossid_reconstructions = list(set.union(*pairwise_intersections))
-                else:
-                    crossid_reconstructions = []
+            # the intersection of all doculects, or if empty, the kinda lenient
+            # union of the intersections of every pair of doculects
+            crossid_reconstructions, strict = infer_reconstructions(reconsts.values())
 
             crossid_reconstructions = ["*" + w for w in crossid_reconstructions]
 
@@ -647,12 +638,11 @@ def compile_to_json(filepath):
             sortkey_of_crossid[crossid] = (1, str(first_form))
 
         # merge with disjoint sets
-        ds.add(crossid, crossid)
         for reconst in crossid_reconstructions:
             if reconst not in first_crossid_of_reconstruction:
-                first_crossid_of_reconstruction[reconst] = crossid
+                first_crossid_of_reconstruction[reconst] = ds.id(crossid)
             else:
-                ds.add(first_crossid_of_reconstruction[reconst], crossid)
+                merged.append((first_crossid_of_reconstruction[reconst], ds.id(crossid)))
 
         # Only output items when the reconstruction is reliable, i.e.
         # reconstruction present and based on more than one language, are printed
@@ -667,16 +657,16 @@ def compile_to_json(filepath):
 
     # Sort crossids according to reconstruction / form
     # taken from ds
-    display_crossids = sorted(
-        ds.group.keys(), key=lambda crossid: sortkey_of_crossid[crossid]
-    )
+    ds.union_many(merged)
+    groups = ds.groups()
+    display_crossids = sorted(groups, key=lambda crossid: sortkey_of_crossid[crossid])
 
     boardid_cntr = 1
 
     # Second round: print the actual content from display_crossids
     for major_crossid in display_crossids:
         # get crossids sharing the same reconstruction
-        crossids = sorted(ds.group[major_crossid])
+        crossids = sorted(groups[major_crossid])
 
         # get reconstructions and strictness
         strict = all([strictness_of_crossid[crossid] for crossid in crossids])
@@ -689,20 +679,8 @@ def compile_to_json(filepath):
         all_reconstructions = [
             set(reconstructions_of_crossid[crossid]) for crossid in crossids
         ]
-        reconstructions = list(set.intersection(*all_reconstructions))
-
-        if not reconstructions:
-            strict = False
-            pairwise_intersections = [
-                set.intersection(all_reconstructions[a], all_reconstructions[b])
-                for a in range(len(all_reconstructions))
-                for b in range(len(all_reconstructions))
-                if a != b
-            ]
-            if pairwise_intersections:
-                reconstructions = list(set.union(*pairwise_intersections))
-            else:
-                reconstructions = []
+        reconstructions, strict_title = infer_reconstructions(all_reconstructions)
+        strict = strict and strict_title
 
         board_id = "board-" + str(boardid_cntr)
         boardid_cntr += 1
@@ -726,12 +704,11 @@ def compile_to_json(filepath):
 
     # calculate json_fst_down
     for language in json_fst_doculects:
-        for proto_form in sorted(attested_reconstructions):
+        proto_forms = sorted(attested_reconstructions)
+        forms_of_proto = apply_down_many(fsts[language], proto_forms)
+        for proto_form in proto_forms:
             json_fst_down[language][proto_form] = sorted(
-                set(
-                    replace_diacritics_down(s)
-                    for s in fsts[language].apply_down(proto_form)
-                )
+                set(replace_diacritics_down(s) for s in forms_of_proto[proto_form])
             )
 
     return {
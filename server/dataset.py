@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# Columnar loader for aligned TSV wordlists (data/*.tsv, lexicon.tsv)
+#
+# The file is read line by line into one array of string ids per column,
+# where every distinct cell value is stored once in a table shared by all
+# columns. Doculects, concepts, structures and cognate ids repeat across
+# thousands of rows, so this is much smaller than a dict per row, and rows
+# are only turned back into strings while they are being iterated over.
+#
+# Lines starting with "#" and blank lines are skipped, the first remaining
+# line is the header. Rows are numbered from 0 in file order.
+#
+# Usage:
+#   dataset = load_dataset("data/burmish-aligned-final.tsv")
+#   for doculect, tokens in dataset.rows("DOCULECT", "TOKENS"):
+#       ...
+
+import sys
+from array import array
+
+# Columns kept by default, when present in the file
+DATASET_COLUMNS = (
+    "ID",
+    "DOCULECT",
+    "CONCEPT",
+    "GLOSSID",
+    "IPA",
+    "TOKENS",
+    "STRUCTURE",
+    "COGIDS",
+    "CROSSIDS",
+)
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class Dataset(object):
+    """Columns of a TSV wordlist, each an array of ids into a string table."""
+
+    def __init__(self, columns):
+        self.columns = {name: array("I") for name in columns}
+        self.strings = []  # id -> value
+        self.ids = {}  # value -> id
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def intern(self, value):
+        """Id of value in the string table, adding it if new."""
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def append(self, values):
+        """Add a row, given as {column: value}; missing columns are empty."""
+        for name, column in self.columns.items():
+            column.append(self.intern(values.get(name, "")))
+
+    def value(self, row, name):
+        return self.strings[self.columns[name][row]]
+
+    def column(self, name):
+        """Iterate over the values of a column, in row order."""
+        strings = self.strings
+        return (strings[i] for i in self.columns[name])
+
+    def rows(self, *names):
+        """Iterate over rows as tuples of the named columns."""
+        strings = self.strings
+        return (
+            tuple(strings[i] for i in ids)
+            for ids in zip(*(self.columns[name] for name in names))
+        )
+
+    def dicts(self, *names):
+        """Iterate over rows as {column: value} for the named (or all) columns."""
+        names = names or tuple(self.columns)
+        return (dict(zip(names, row)) for row in self.rows(*names))
+
+
+def load_dataset(path, columns=DATASET_COLUMNS):
+    """
+    Stream a TSV wordlist into a Dataset.
+
+    :param path: path of the TSV file
+    :param columns: names of the columns to keep, None for all of them
+    :return: Dataset with the kept columns found in the header
+    """
+    dataset = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            cells = [cell.strip() for cell in line.split("\t")]
+            if dataset is None:
+                header = cells
+                kept = [
+                    (i, name)
+                    for i, name in enumerate(header)
+                    if columns is None or name in columns
+                ]
+                dataset = Dataset([name for _, name in kept])
+                continue
+            if not cells[0] or cells[0].startswith("#"):
+                continue
+            dataset.append({name: cells[i] for i, name in kept if i < len(cells)})
+    if dataset is None:
+        raise ValueError(f"{path} has no header")
+    eprint(f"Loaded {len(dataset)} rows from {path}")
+    return dataset
@@ -1,30 +1,84 @@
+from array import array
+
+import numpy as np
+
+
 class DisjointSet(object):
+    """
+    Union-find over members numbered in the order they are added.
+
+    Parents and group sizes are kept in integer arrays, with path halving on
+    lookups and union by size. When two groups of the same size merge, the
+    group of the first argument absorbs the other, so the leader of a group
+    only depends on the order of the unions. Groups are only gathered when
+    asked for.
+    """
+
+    def __init__(self, members=()):
+        self.ids = {}  # maps a member to its id
+        self.members = []  # maps an id to its member
+        self.parent = array("l")
+        self.size = array("l")
+        self._groups = None
+        for member in members:
+            self.id(member)
+
+    def __len__(self):
+        return len(self.members)
 
-    def __init__(self):
-        self.leader = {} # maps a member to the group's leader
-        self.group = {} # maps a group leader to the group (which is a set)
+    def id(self, member):
+        """Id of a member, adding it as a group of its own if new."""
+        i = self.ids.get(member)
+        if i is None:
+            i = self.ids[member] = len(self.members)
+            self.members.append(member)
+            self.parent.append(i)
+            self.size.append(1)
+            self._groups = None
+        return i
+
+    def find(self, i):
+        """Id of the leader of the group of id i."""
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        """Merge the groups of ids i and j."""
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return  # nothing to do
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self._groups = None
+
+    def union_many(self, pairs):
+        """Merge the groups of each pair of ids, in order (e.g. an n×2 array)."""
+        for i, j in np.asarray(pairs, dtype=np.int64).reshape(-1, 2).tolist():
+            self.union(i, j)
 
     def add(self, a, b):
-        leadera = self.leader.get(a)
-        leaderb = self.leader.get(b)
-        if leadera is not None:
-            if leaderb is not None:
-                if leadera == leaderb: return # nothing to do
-                groupa = self.group[leadera]
-                groupb = self.group[leaderb]
-                if len(groupa) < len(groupb):
-                    a, leadera, groupa, b, leaderb, groupb = b, leaderb, groupb, a, leadera, groupa
-                groupa |= groupb
-                del self.group[leaderb]
-                for k in groupb:
-                    self.leader[k] = leadera
-            else:
-                self.group[leadera].add(b)
-                self.leader[b] = leadera
-        else:
-            if leaderb is not None:
-                self.group[leaderb].add(a)
-                self.leader[a] = leaderb
-            else:
-                self.leader[a] = self.leader[b] = a
-                self.group[a] = set([a, b])
+        """Merge the groups of members a and b, adding them if new."""
+        self.union(self.id(a), self.id(b))
+
+    def leader(self, member):
+        return self.members[self.find(self.ids[member])]
+
+    def groups(self):
+        """Map each group leader to the list of its members, in order of addition."""
+        if self._groups is None:
+            groups = {}
+            for i in range(len(self.members)):
+                leader = self.find(i)
+                if leader not in groups:
+                    groups[leader] = []
+                groups[leader].append(self.members[i])
+            self._groups = {
+                self.members[leader]: groups[leader] for leader in sorted(groups)
+            }
+        return self._groups
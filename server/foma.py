@@ -20,6 +20,14 @@
 from sys import maxsize
 from ctypes import *
 from ctypes.util import find_library
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
 
 import six_1_11_0 as six
 
@@ -27,6 +35,16 @@ fomalibpath = find_library('foma')
 foma = cdll.LoadLibrary(fomalibpath)
 
 
+class SigmaStruct(Structure):
+    pass
+
+SigmaStruct._fields_ = [
+    ("number", c_int),
+    ("symbol", c_char_p),
+    ("next", POINTER(SigmaStruct))
+]
+
+
 class FSTstruct(Structure):
     _fields_ = [
         ("name", c_char * 40),
@@ -45,7 +63,7 @@ class FSTstruct(Structure):
         ("arcs_sorted_in", c_int),
         ("arcs_sorted_out", c_int),
         ("fsm_state", c_void_p),
-        ("sigma", c_void_p),
+        ("sigma", POINTER(SigmaStruct)),
         ("medlookup", c_void_p)
     ]
 
@@ -101,11 +119,17 @@ foma_fsm_flatten.restype = POINTER(FSTstruct)
 foma_apply_set_space_symbol = foma.apply_set_space_symbol
 foma_fsm_read_binary_file = foma.fsm_read_binary_file
 foma_fsm_read_binary_file.restype = POINTER(FSTstruct)
+foma_fsm_write_binary_file = foma.fsm_write_binary_file
+foma_fsm_write_binary_file.restype = c_int
 
 
 """Define functions."""
 foma_add_defined = foma.add_defined
 foma_add_defined.restype = c_int
+foma_find_defined = foma.find_defined
+foma_find_defined.restype = POINTER(FSTstruct)
+foma_remove_defined = foma.remove_defined
+foma_remove_defined.restype = c_int
 #foma_add_defined_function = foma.add_defined_function
 #foma_add_defined_function.restype = c_int
 defined_networks_init = foma.defined_networks_init
@@ -131,19 +155,49 @@ class FSTfunctiondefinitions(object):
         self.deffhandle = defined_functions_init(None)
 
 
+# foma's regex parser keeps its state in globals
+compile_lock = threading.RLock()
+
+# Definitions made with FST.define, one pair of tables per thread
+_thread_definitions = threading.local()
+
+# apply_init reads networks shared between threads; only run one at a time
+_applyer_lock = threading.Lock()
+
+
+class _Applyer(object):
+    """Applyer handle of one thread on one network, cleared when dropped."""
+    def __init__(self, fsthandle):
+        self.net = cast(fsthandle, c_void_p).value
+        with _applyer_lock:
+            self.handle = foma_apply_init(fsthandle)
+
+    def __del__(self):
+        if self.handle:
+            foma_apply_clear(c_void_p(self.handle))
+
+
 class FST(object):
-    networkdefinitions = FSTnetworkdefinitions()
-    functiondefinitions = FSTfunctiondefinitions()
+
+    @staticmethod
+    def definitions():
+        """This thread's (network, function) definition tables."""
+        if not hasattr(_thread_definitions, 'networks'):
+            _thread_definitions.networks = FSTnetworkdefinitions()
+            _thread_definitions.functions = FSTfunctiondefinitions()
+        return _thread_definitions.networks, _thread_definitions.functions
 
     @classmethod
     def define(cls, definition, name):
         """Defines an FSM constant; can be supplied regex or existing FSM."""
         name = cls.encode(name)
+        networkdefinitions, functiondefinitions = cls.definitions()
         if isinstance(definition, FST):
-            retval = foma.add_defined(c_void_p(cls.networkdefinitions.defhandle), foma_fsm_copy(definition.fsthandle), c_char_p(name))
+            retval = foma.add_defined(c_void_p(networkdefinitions.defhandle), foma_fsm_copy(definition.fsthandle), c_char_p(name))
         elif isinstance(definition, basestring):
             regex = cls.encode(definition)
-            retval = foma.add_defined(c_void_p(cls.networkdefinitions.defhandle), foma_fsm_parse_regex(c_char_p(regex), c_void_p(cls.networkdefinitions.defhandle), c_void_p(cls.functiondefinitions.deffhandle)), c_char_p(name))
+            with compile_lock:
+                retval = foma.add_defined(c_void_p(networkdefinitions.defhandle), foma_fsm_parse_regex(c_char_p(regex), c_void_p(networkdefinitions.defhandle), c_void_p(functiondefinitions.deffhandle)), c_char_p(name))
         else:
             raise ValueError("Expected str, unicode, or FSM")
 
@@ -185,6 +239,41 @@ class FST(object):
             raise ValueError("File error.")
         return fsm
 
+    def save(self, filename):
+        """Save FSM to binary file, as foma's `save stack` does."""
+        if not self.fsthandle:
+            raise ValueError('FST not defined')
+        if foma_fsm_write_binary_file(self.fsthandle, c_char_p(FST.encode(filename))) != 0:
+            raise ValueError("File error.")
+
+    def to_bytes(self):
+        """Contents of the binary file save() would write."""
+        fd, filename = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+        try:
+            self.save(filename)
+            with open(filename, 'rb') as fp:
+                return fp.read()
+        finally:
+            os.remove(filename)
+
+    def digest(self):
+        """SHA-256 of the binary file of the FSM, identifying the network."""
+        if getattr(self, '_digest', None) is None:
+            self._digest = hashlib.sha256(self.to_bytes()).hexdigest()
+        return self._digest
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load FSM from the contents of a binary file."""
+        fd, filename = tempfile.mkstemp(suffix='.bin')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            return cls.load(filename)
+        finally:
+            os.remove(filename)
+
     @staticmethod
     def encode(string):
         # type: (Any) -> six.binary_type
@@ -210,28 +299,39 @@ class FST(object):
     def __init__(self, regex = False):
         if regex:
             self.regex = self.encode(regex)
-            self.fsthandle = foma_fsm_parse_regex(c_char_p(self.regex), c_void_p(self.networkdefinitions.defhandle), c_void_p(self.functiondefinitions.deffhandle))
+            networkdefinitions, functiondefinitions = self.definitions()
+            with compile_lock:
+                self.fsthandle = foma_fsm_parse_regex(c_char_p(self.regex), c_void_p(networkdefinitions.defhandle), c_void_p(functiondefinitions.deffhandle))
             if not self.fsthandle:
                 raise ValueError("Syntax error in regex")
         else:
             self.fsthandle = None
-        self.getitemapplyer = None
+        self.applyers = threading.local()
+
+    def _applyer(self):
+        """This thread's applyer handle, created on first use and cleared
+           when the thread exits or the FSM is deleted."""
+        applyer = getattr(self.applyers, 'applyer', None)
+        if applyer is None or applyer.net != cast(self.fsthandle, c_void_p).value:
+            applyer = self.applyers.applyer = _Applyer(self.fsthandle)
+        return applyer.handle
 
     def __getitem__(self, key):
         if not self.fsthandle:
             raise KeyError('FST not defined')
-        if not self.getitemapplyer:
-            self.getitemapplyer = foma_apply_init(self.fsthandle)
+        applyerhandle = self._applyer()
         result = []
-        output = foma_apply_down(c_void_p(self.getitemapplyer), c_char_p(self.encode(key)))
+        output = foma_apply_down(c_void_p(applyerhandle), c_char_p(self.encode(key)))
         while True:
             if output == None:
                 return result
             else:
                 result.append(output)
-                output = foma_apply_down(c_void_p(self.getitemapplyer), None)
+                output = foma_apply_down(c_void_p(applyerhandle), None)
             
     def __del__(self):
+        # the applyers of every thread go before the network they point to
+        self.applyers = None
         if self.fsthandle:
             foma_fsm_destroy(self.fsthandle)
 
@@ -320,7 +420,7 @@ class FST(object):
             raise ValueError('FST not defined')
         applyerhandle = foma_apply_init(self.fsthandle)
         if tokenize:
-            toksym = '\x07'
+            toksym = b'\x07'
             foma_apply_set_space_symbol(c_void_p(applyerhandle), c_char_p(toksym))
         if word:
             output = applyf(c_void_p(applyerhandle), c_char_p(self.encode(word)))
@@ -332,7 +432,7 @@ class FST(object):
                 return
             else:
                 if tokenize:
-                    yield output[:-1].split('\x07')
+                    yield self.decode(output)[:-1].split('\x07')
                 else:
                     yield self.decode(output)
             if word:
@@ -358,6 +458,88 @@ class FST(object):
         else:
             raise ValueError('Undefined FST')
 
+    def _apply_many(self, applyf, words):
+        if not self.fsthandle:
+            raise ValueError('Undefined FST')
+        # each distinct word is looked up once, in order of appearance
+        encoded = [(word, self.encode(word)) for word in dict.fromkeys(words)]
+        results = {}
+        applyerhandle = self._applyer()
+        for word, encoded_word in encoded:
+            outputs = []
+            output = applyf(c_void_p(applyerhandle), c_char_p(encoded_word))
+            while output is not None:
+                outputs.append(self.decode(output))
+                output = applyf(c_void_p(applyerhandle), None)
+            results[word] = tuple(outputs)
+        return results
+
+    def apply_down_many(self, words):
+        """Apply down every word with this thread's applyer.
+           Returns {word: tuple of outputs}."""
+        return self._apply_many(foma_apply_down, words)
+
+    def apply_up_many(self, words):
+        """Apply up every word with this thread's applyer.
+           Returns {word: tuple of outputs}."""
+        return self._apply_many(foma_apply_up, words)
+
+    def multichar_symbols(self):
+        """Symbols of the alphabet longer than one character, apart from
+           foma's epsilon, unknown and identity symbols."""
+        if not self.fsthandle:
+            raise ValueError('Undefined FST')
+        symbols = set()
+        sigma = self.fsthandle.contents.sigma
+        while sigma and sigma.contents.symbol is not None:
+            symbol = self.decode(sigma.contents.symbol)
+            if sigma.contents.number > 2 and len(symbol) > 1:
+                symbols.add(symbol)
+            sigma = sigma.contents.next
+        return symbols
+
+    def apply_up_wordlist(self, words):
+        """Apply up every word by composing with a wordlist of them and
+           enumerating the restricted relation once.
+           Returns {word: tuple of unique outputs}, as apply_up would give.
+           Words containing a multichar symbol of the alphabet, which apply_up
+           reads as one symbol but the wordlist splits into characters, and
+           words the restricted relation has no path for are looked up with
+           apply_up_many."""
+        if not self.fsthandle:
+            raise ValueError('Undefined FST')
+        words = list(dict.fromkeys(words))
+        multichar = sorted(self.multichar_symbols(), key = len, reverse = True)
+        if multichar:
+            spelled = re.compile('|'.join(map(re.escape, multichar)))
+            outputs = {word: {} for word in words if not spelled.search(word)}
+        else:
+            outputs = {word: {} for word in words}
+        if not outputs:
+            return self._apply_many(foma_apply_up, words)
+        restricted = self.compose(FST.wordlist(outputs))
+        try:
+            len(restricted)
+        except ValueError:
+            # cyclic: infinitely many outputs, enumeration would not terminate
+            return self._apply_many(foma_apply_up, words)
+        unknown = set()
+        # flattened paths alternate upper and lower symbols, □ for epsilon
+        for path in restricted.flatten().words(tokenize = True):
+            upper = path[0::2]
+            lower = ''.join(sym for sym in path[1::2] if sym != '□')
+            if lower not in outputs:
+                continue
+            if any(sym.startswith('@_') for sym in upper):
+                unknown.add(lower)
+            else:
+                outputs[lower][''.join(sym for sym in upper if sym != '□')] = True
+        results = {word: tuple(found) for word, found in outputs.items()
+                   if found and word not in unknown}
+        missing = [word for word in words if word not in results]
+        results.update(self._apply_many(foma_apply_up, missing))
+        return results
+
     def _fomacallunary(self, func, minimize = True):
         if self.fsthandle:
             handle = func(foma_fsm_copy(self.fsthandle))
@@ -432,6 +614,7 @@ class MTFSM(FST):
         else:
             self.fsthandle = None
             self.regex = None
+        self.applyers = threading.local()
         
         
     def __str__(self):
@@ -526,3 +709,205 @@ class MTFSM(FST):
             else:
                 yield self._fmt(output[:-1].split('\x07'))
             output = applyf(c_void_p(applyerhandle))
+
+
+"""Script compilation."""
+
+from foma_script import FomaStatement, ScriptGraph, parse_script
+
+
+def _network_size(fsm):
+    foma_fsm_count(fsm.fsthandle)
+    return fsm.fsthandle.contents.statecount + fsm.fsthandle.contents.arccount
+
+
+class NetworkCache(object):
+    """LRU cache of compiled networks by fingerprint, bounded by the total
+       number of states and arcs held."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.networks = OrderedDict()
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.networks
+
+    def get(self, fingerprint):
+        fsm = self.networks.get(fingerprint)
+        if fsm is not None:
+            self.networks.move_to_end(fingerprint)
+        return fsm
+
+    def add(self, fingerprint, fsm):
+        if fingerprint in self.networks:
+            return
+        self.networks[fingerprint] = fsm
+        self.size += _network_size(fsm)
+        while self.size > self.max_size and len(self.networks) > 1:
+            _, evicted = self.networks.popitem(last=False)
+            self.size -= _network_size(evicted)
+
+    def clear(self):
+        self.networks.clear()
+        self.size = 0
+
+
+# Networks of unchanged defines and saves are kept between compiles
+compiled_networks = NetworkCache(20000000)
+
+
+def _parse_regex(regex, definitions, functions):
+    """Compile a regex against the given definition tables; None on error."""
+    handle = foma_fsm_parse_regex(c_char_p(FST.encode(regex)), c_void_p(definitions.defhandle), c_void_p(functions.deffhandle))
+    return handle if handle else None
+
+
+def _network(handle):
+    fsm = FST()
+    fsm.fsthandle = handle
+    return fsm
+
+
+def compile_script(script, processes=1):
+    """Compile a foma script in-process, as `foma -f` would.
+       Returns ({name: FST}, errors) where name is the file name given to
+       `save stack` without its extension.
+       Only statements that changed since an earlier compile, and those
+       depending on them, are compiled again; see ScriptGraph.
+       With more than one process, each `save stack` target is compiled
+       separately on a pool of that many processes."""
+    statements = parse_script(script)
+    if processes > 1:
+        return _compile_parallel(statements, processes)
+    return _compile_statements(statements)
+
+
+def _compile_statements(statements):
+    networks = {}
+    errors = []
+    stack = []  # compiled networks, or None for those not needed
+    defined_names = set()
+    failed = set()  # statements whose network is missing or built from errors
+
+    graph = ScriptGraph(statements)
+
+    with compile_lock:
+        # Hold on to what is already compiled, in case the cache evicts it
+        known = {}
+        for fingerprint in graph.fingerprints:
+            if fingerprint and fingerprint in compiled_networks:
+                known[fingerprint] = compiled_networks.get(fingerprint)
+        needed = graph.needed(lambda fingerprint: fingerprint in known)
+
+        def remember(i, fsm):
+            if i not in failed:
+                known[graph.fingerprints[i]] = fsm
+                compiled_networks.add(graph.fingerprints[i], fsm)
+
+        # Each compile gets its own definition tables
+        definitions = FSTnetworkdefinitions()
+        functions = FSTfunctiondefinitions()
+        try:
+            for i, statement in enumerate(graph.statements):
+                where = 'line %i' % statement.line
+                if any(d in failed for d in graph.deps[i]):
+                    failed.add(i)
+
+                if statement.command in ('define', 'regex'):
+                    fsm = None
+                    if not statement.regex:
+                        # "define NAME;" takes the network on top of the stack
+                        if stack:
+                            fsm = stack.pop()
+                        elif i in needed:
+                            errors.append('%s: stack is empty, cannot define %s' % (where, statement.name))
+                    elif i in needed:
+                        fsm = known.get(graph.fingerprints[i])
+                        if fsm is None:
+                            handle = _parse_regex(statement.regex, definitions, functions)
+                            if handle is None:
+                                if statement.command == 'define':
+                                    errors.append('%s: syntax error in definition of %s' % (where, statement.name))
+                                else:
+                                    errors.append('%s: syntax error in regex' % where)
+                                failed.add(i)
+                            else:
+                                fsm = _network(handle)
+                                remember(i, fsm)
+
+                    if statement.command == 'regex':
+                        stack.append(fsm)
+                    elif fsm is not None:
+                        # the definition table owns (and frees) what it holds
+                        foma_add_defined(c_void_p(definitions.defhandle), foma_fsm_copy(fsm.fsthandle), c_char_p(FST.encode(statement.name)))
+                        defined_names.add(statement.name)
+                elif statement.command == 'push':
+                    fsm = None
+                    if i in needed:
+                        handle = foma_find_defined(c_void_p(definitions.defhandle), c_char_p(FST.encode(statement.name)))
+                        if not handle:
+                            errors.append('%s: %s is not defined' % (where, statement.name))
+                            failed.add(i)
+                        else:
+                            fsm = _network(foma_fsm_copy(handle))
+                    stack.append(fsm)
+                elif statement.command == 'pop':
+                    if stack:
+                        stack.pop()
+                elif statement.command == 'clear':
+                    stack = []
+                elif statement.command == 'save':
+                    if not stack:
+                        errors.append('%s: stack is empty, nothing to save in %s' % (where, statement.name))
+                        continue
+                    fsm = known.get(graph.fingerprints[i]) if i not in failed else None
+                    if fsm is None:
+                        fsm = stack[-1]
+                        if fsm is None:
+                            continue
+                        remember(i, fsm)
+                    name = os.path.splitext(os.path.basename(statement.name))[0]
+                    networks[name] = fsm
+                else:
+                    errors.append('%s: unsupported command: %s' % (where, statement.name))
+        finally:
+            for name in defined_names:
+                foma_remove_defined(c_void_p(definitions.defhandle), c_char_p(FST.encode(name)))
+
+    return networks, errors
+
+
+_compile_pools = {}
+_compile_pools_lock = threading.Lock()
+
+
+def _compile_pool(processes):
+    # A pool belongs to the process that started it: a gunicorn worker forked
+    # after the warm-up compiled in the master (preload_app) starts its own
+    key = (os.getpid(), processes)
+    with _compile_pools_lock:
+        if key not in _compile_pools:
+            # spawn rather than fork, as forking while another thread holds
+            # compile_lock would leave the child waiting on it forever
+            _compile_pools[key] = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        return _compile_pools[key]
+
+
+def _compile_unit(statements):
+    networks, errors = _compile_statements(statements)
+    return {name: fsm.to_bytes() for name, fsm in networks.items()}, errors
+
+
+def _compile_parallel(statements, processes):
+    units = ScriptGraph(statements).units()
+    networks = {}
+    errors = []
+    pool = _compile_pool(processes)
+    for unit_networks, unit_errors in pool.map(_compile_unit, [[statements[i] for i in unit] for unit in units]):
+        for name, data in unit_networks.items():
+            networks[name] = FST.from_bytes(data)
+        # statements shared by several units report their errors once
+        errors.extend(error for error in unit_errors if error not in errors)
+    return networks, errors
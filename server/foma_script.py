@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# Parsing of foma scripts and their dependency graph, for foma.compile_script
+#
+# Kept apart from foma.py, which loads libfoma on import, as none of this
+# needs the library.
+#
+# Usage:
+#   statements = parse_script(script_text)
+#   graph = ScriptGraph(statements)
+#   graph.needed(lambda fingerprint: fingerprint in compiled)
+
+from collections import namedtuple
+import hashlib
+import re
+
+
+# One command of a foma script. command is one of define, regex, push, pop,
+# clear, save or unsupported; name is the defined name, pushed name or saved
+# file; regex is the regular expression text without its closing ';'.
+FomaStatement = namedtuple('FomaStatement', ['command', 'name', 'regex', 'line'])
+
+def _read_regex(script, i, line):
+    """Read a regex up to its closing ';', dropping comments.
+       Returns (regex, index after the ';', line number)."""
+    n = len(script)
+    out = []
+    while i < n:
+        c = script[i]
+        if c == ';':
+            return ''.join(out), i + 1, line
+        elif c == '"':
+            end = script.find('"', i + 1)
+            end = n - 1 if end == -1 else end
+            out.append(script[i:end + 1])
+            line += script.count('\n', i, end + 1)
+            i = end + 1
+        elif c == '%':
+            out.append(script[i:i + 2])
+            line += script.count('\n', i, i + 2)
+            i += 2
+        elif script.startswith('.#.', i):
+            out.append('.#.')
+            i += 3
+        elif c == '#':
+            end = script.find('\n', i)
+            i = n if end == -1 else end
+        else:
+            if c == '\n':
+                line += 1
+            out.append(c)
+            i += 1
+    return ''.join(out), i, line
+
+
+def parse_script(script):
+    """Split the text of a foma script into a list of FomaStatement."""
+    statements = []
+    n = len(script)
+    i = 0
+    line = 1
+    while i < n:
+        c = script[i]
+        if c == '\n':
+            line += 1
+            i += 1
+            continue
+        if c.isspace() or c == ';':
+            i += 1
+            continue
+        if c == '#':
+            end = script.find('\n', i)
+            i = n if end == -1 else end
+            continue
+
+        start_line = line
+        j = i
+        while j < n and not script[j].isspace() and script[j] != ';':
+            j += 1
+        command = script[i:j]
+
+        if command in ('define', 'def', 'regex'):
+            name = None
+            if command != 'regex':
+                while j < n and script[j] in ' \t':
+                    j += 1
+                k = j
+                while k < n and not script[k].isspace() and script[k] != ';':
+                    k += 1
+                name = script[j:k]
+                j = k
+            regex, i, line = _read_regex(script, j, line)
+            if name and '(' in name:
+                # "define F(X) ...;" defines a function, which compile_script
+                # does not implement; report it rather than define "F(X)"
+                head = name + regex
+                head = head[:head.find(')') + 1] if ')' in head else name
+                statements.append(FomaStatement('unsupported', '%s %s' % (command, ' '.join(head.split())),
+                                                None, start_line))
+                continue
+            statements.append(FomaStatement('regex' if command == 'regex' else 'define',
+                                            name, regex.strip(), start_line))
+            continue
+
+        # Every other command takes the rest of the line
+        end = script.find('\n', j)
+        end = n if end == -1 else end
+        args = script[j:end].split('#')[0].split()
+        i = end
+        if command in ('clear', 'pop') and args in ([], ['stack']):
+            statements.append(FomaStatement(command, None, None, start_line))
+        elif command == 'push' and (len(args) == 1 or (len(args) == 2 and args[0] == 'defined')):
+            statements.append(FomaStatement('push', args[-1], None, start_line))
+        elif command == 'save' and len(args) == 2 and args[0] == 'stack':
+            statements.append(FomaStatement('save', args[1], None, start_line))
+        else:
+            statements.append(FomaStatement('unsupported', ' '.join([command] + args), None, start_line))
+    return statements
+
+
+# Characters that can separate a defined name from the rest of a regex
+_NAME_SEPARATORS = r'\s!"#$%&\'()*+,\-./:;<=>?@\[\\\]^_`{|}~¬∘→←↔∪∩×⊗∖'
+_name_separator_re = re.compile('[%s]' % _NAME_SEPARATORS)
+_name_re = re.compile('[^%s]+' % _NAME_SEPARATORS)
+
+
+def _referenced_names(regex, names):
+    """The names in names that regex may refer to. Errs on the side of
+       reporting too many, so that no real dependency is ever missed."""
+    tokens = set(_name_re.findall(regex))
+    return [name for name in names
+            if name in tokens or (_name_separator_re.search(name) and name in regex)]
+
+
+def _fingerprint(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ScriptGraph(object):
+    """Dependency graph of a parsed foma script.
+
+       deps[i] holds the indices of the statements whose networks statement i
+       uses: the defines its regex refers to, the define it pushes, or the
+       statement that put the network it saves or defines on the stack.
+       fingerprints[i] identifies the network statement i produces by its
+       regex and the fingerprints of its dependencies, so it only changes
+       when the statement or something it depends on is edited."""
+
+    def __init__(self, statements):
+        self.statements = statements
+        self.deps = []
+        self.fingerprints = []
+        latest = {}  # name -> index of the define currently in effect
+        stack = []  # indices of the statements that produced the stack
+        for i, statement in enumerate(statements):
+            deps = []
+            fingerprint = None
+            if statement.command in ('define', 'regex') and statement.regex:
+                deps = [latest[name] for name in _referenced_names(statement.regex, latest)]
+                fingerprint = _fingerprint(statement.regex, *sorted(
+                    statements[d].name + '=' + self.fingerprints[d] for d in deps if self.fingerprints[d]))
+            elif statement.command in ('define', 'save') and stack:
+                # defines and saves the network on top of the stack
+                deps = [stack[-1]]
+                fingerprint = self.fingerprints[stack[-1]]
+            elif statement.command == 'push' and statement.name in latest:
+                deps = [latest[statement.name]]
+                fingerprint = self.fingerprints[deps[0]]
+
+            if statement.command == 'define':
+                if not statement.regex and stack:
+                    stack.pop()
+                latest[statement.name] = i
+            elif statement.command in ('regex', 'push'):
+                stack.append(i)
+            elif statement.command == 'pop' and stack:
+                stack.pop()
+            elif statement.command == 'clear':
+                stack = []
+            self.deps.append(deps)
+            self.fingerprints.append(fingerprint)
+
+    def closure(self, roots):
+        """Sorted indices of the statements in roots and all they depend on."""
+        seen = set()
+        todo = list(roots)
+        while todo:
+            i = todo.pop()
+            if i not in seen:
+                seen.add(i)
+                todo.extend(self.deps[i])
+        return sorted(seen)
+
+    def units(self):
+        """Split the script into units that compile independently: one per
+           `save stack`, holding only the statements its network is built
+           from, and one with whatever is left, so that its errors are
+           still reported."""
+        units = []
+        covered = set()
+        for i, statement in enumerate(self.statements):
+            if statement.command == 'save':
+                unit = self.closure([i])
+                units.append(unit)
+                covered.update(unit)
+        rest = [i for i, statement in enumerate(self.statements)
+                if i not in covered and (statement.command == 'unsupported' or statement.regex)]
+        if rest:
+            units.append(self.closure(rest))
+        return units
+
+    def needed(self, cached):
+        """Indices of the statements to execute when the networks whose
+           fingerprints satisfy cached() are already compiled: everything that
+           changed, and whatever those changes are built from."""
+        todo = [i for i, statement in enumerate(self.statements)
+                if statement.command in ('define', 'regex', 'save')
+                and not (self.fingerprints[i] and cached(self.fingerprints[i]))]
+        needed = set()
+        while todo:
+            i = todo.pop()
+            if i in needed:
+                continue
+            needed.add(i)
+            statement = self.statements[i]
+            # a cached regex can be copied without its dependencies
+            if statement.regex and self.fingerprints[i] and cached(self.fingerprints[i]):
+                continue
+            todo.extend(self.deps[i])
+        return needed
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# Content-addressed cache of compiled transducers
+#
+# A foma script always compiles to the same `save stack` networks, so the
+# outputs are keyed by a hash of the script text. Compiled networks are kept
+# both in memory (as loaded FST objects) and on disk (as .bin files), each
+# bounded in size with least-recently-used eviction.
+#
+# Usage:
+#   networks, errors = compile_transducer(script_text)
+#   networks["maru"]  # the network saved with `save stack maru.bin`
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from foma import FST, compile_script
+
+# Where compiled binaries are kept between requests and server restarts
+FST_CACHE_DIR = os.environ.get(
+    "CAPR_FST_CACHE_DIR", os.path.join(tempfile.gettempdir(), "capr-fst-cache")
+)
+# Upper bounds (in bytes of .bin output) for the two cache levels
+FST_CACHE_MEMORY_BYTES = int(
+    os.environ.get("CAPR_FST_CACHE_MEMORY_BYTES", 256 * 1024 * 1024)
+)
+FST_CACHE_DISK_BYTES = int(
+    os.environ.get("CAPR_FST_CACHE_DISK_BYTES", 1024 * 1024 * 1024)
+)
+# Compile each `save stack` target on its own process when above 1
+FST_COMPILE_PROCESSES = int(os.environ.get("CAPR_FST_COMPILE_PROCESSES", 1))
+
+# Name of the file holding the compiler messages next to the binaries
+ERRORS_FILE = "errors.txt"
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def script_hash(script):
+    """Hash identifying a foma script, used as the cache key."""
+    return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(path, f))
+        for f in os.listdir(path)
+        if os.path.isfile(os.path.join(path, f))
+    )
+
+
+class CompiledFSTCache(object):
+    """
+    Two-level LRU cache of compiled foma scripts.
+
+    Entries map a script hash to ({name: FST}, errors), where name is the
+    file name given to `save stack` without its .bin extension.
+    """
+
+    def __init__(self, directory, memory_bytes, disk_bytes, processes=1):
+        self.directory = directory
+        self.processes = processes
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()  # hash -> (networks, errors, size)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                networks, errors, _ = self.entries[key]
+                return dict(networks), list(errors)
+
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            entry = self._load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # half-evicted or corrupt entry, compile it again
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        self._remember(key, *entry)
+        return dict(entry[0]), list(entry[1])
+
+    def compile(self, script):
+        """Return ({name: FST}, errors) for the script, compiling on a miss."""
+        key = script_hash(script)
+        cached = self.get(key)
+        if cached is not None:
+            eprint(f"Compiled FSTs found in cache ({key[:12]})")
+            return cached
+
+        eprint(f"Compiling FSTs ({key[:12]})")
+        networks, errors = compile_script(script, self.processes)
+        for error in errors:
+            eprint(error)
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmpdirname = tempfile.mkdtemp(dir=self.directory, prefix=".compile-")
+        try:
+            for name, fst in networks.items():
+                fst.save(os.path.join(tmpdirname, name + ".bin"))
+            with open(
+                os.path.join(tmpdirname, ERRORS_FILE), "w", encoding="utf-8"
+            ) as fp:
+                fp.write("\0".join(errors))
+            size = _dir_size(tmpdirname)
+            try:
+                os.rename(tmpdirname, os.path.join(self.directory, key))
+            except OSError:
+                # another worker stored the same script first
+                pass
+        finally:
+            shutil.rmtree(tmpdirname, ignore_errors=True)
+
+        self._remember(key, networks, errors, size)
+        self._evict_disk()
+        return dict(networks), list(errors)
+
+    def _load(self, path):
+        networks = {}
+        size = 0
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".bin"):
+                networks[filename[: -len(".bin")]] = FST.load(
+                    os.path.join(path, filename)
+                )
+                size += os.path.getsize(os.path.join(path, filename))
+        with open(os.path.join(path, ERRORS_FILE), encoding="utf-8") as fp:
+            errors = [err for err in fp.read().split("\0") if err]
+        return networks, errors, size
+
+    def _remember(self, key, networks, errors, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries[key][2]
+            self.entries[key] = (networks, errors, size)
+            self.entries.move_to_end(key)
+            self.size += size
+            # always keep the newest entry, even if it is over budget on its own
+            while self.size > self.memory_bytes and len(self.entries) > 1:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def _evict_disk(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries)[:-1]:
+            if total <= self.disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+compiled_fsts = CompiledFSTCache(
+    FST_CACHE_DIR, FST_CACHE_MEMORY_BYTES, FST_CACHE_DISK_BYTES, FST_COMPILE_PROCESSES
+)
+
+
+def compile_transducer(script):
+    """
+    Compile a foma script through the shared cache.
+
+    :param script: text of the foma script
+    :return: ({name: FST}, errors) where name is the `save stack` file name
+             without .bin, and errors are the messages reported by foma
+    """
+    return compiled_fsts.compile(script)
@@ -0,0 +1,15 @@
+# gunicorn settings, read by `gunicorn server:app` when run from this directory
+
+import os
+
+# Import the app (and warm up its caches) once in the master process; forked
+# workers then share the compiled transducers and reconstructions
+preload_app = True
+
+# Finish the warm-up before forking, so there is something to share
+os.environ.setdefault("CAPR_WARM_BACKGROUND", "0")
+
+# Serve requests on threads, so that long ones (streamed comparisons, job
+# events) do not hold up the others
+worker_class = "gthread"
+threads = int(os.environ.get("CAPR_GUNICORN_THREADS", 8))
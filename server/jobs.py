@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# Background jobs for long refish and compare requests
+#
+# A job runs the same computation as /refish-board, /compare-fst or
+# /compare-fsts on a pool of local processes, so the request that submits it
+# returns at once and the web workers stay free for short requests. While it
+# runs, a job reports the stage it reached (compiling, reconstructing,
+# grouping, serializing); its result is kept, already serialized, for
+# CAPR_JOB_TTL seconds after it finishes.
+#
+# The status and result of every job are kept in an SQLite database, written
+# by the process running the job, so any web worker can report on, cancel or
+# serve the result of a job another worker accepted.
+#
+# Usage:
+#   from jobs import jobs
+#   job_id = jobs.submit("compare-fst", body)
+#   jobs.status(job_id)  # {"id", "kind", "state", "stage", ...}
+#   jobs.result(job_id)  # UTF-8 encoded JSON, once the state is "done"
+
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of processes running jobs, per web worker
+JOB_PROCESSES = int(os.environ.get("CAPR_JOB_PROCESSES", 2))
+# Seconds a finished job and its result are kept
+JOB_TTL = float(os.environ.get("CAPR_JOB_TTL", 600))
+# SQLite database of the status and results of jobs, shared by all workers
+JOB_DB = os.environ.get(
+    "CAPR_JOB_DB", os.path.join(tempfile.gettempdir(), "capr-jobs.db")
+)
+# Seconds a stream of job events stays open before the client reconnects
+JOB_EVENTS_TIMEOUT = float(os.environ.get("CAPR_JOB_EVENTS_TIMEOUT", 25))
+
+# Kinds of jobs: (module, function, required arguments of the request body)
+JOB_KINDS = {
+    "refish-board": (
+        "refish",
+        "refish",
+        ("columns", "boards", "syllables", "fstDoculects", "transducer"),
+    ),
+    "compare-fst": (
+        "compare_fst",
+        "compare_fst",
+        ("langsUnderStudy", "oldTransducer", "newTransducer", "board"),
+    ),
+    "compare-fsts": (
+        "compare_fst",
+        "compare_fsts",
+        ("langsUnderStudy", "transducers", "board"),
+    ),
+}
+
+STAGES = ("compiling", "reconstructing", "grouping", "serializing")
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class JobCancelled(Exception):
+    """The job was cancelled while it was running."""
+
+
+class JobFailed(Exception):
+    """The job raised an exception, whose message this carries."""
+
+
+class UnknownJob(KeyError):
+    """The job expired or never existed."""
+
+
+class JobStore(object):
+    """Status and serialized result of jobs, in an SQLite database."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = None
+        self.db_pid = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # An SQLite connection can't be used across fork(), so every process
+        # (e.g. each gunicorn worker after --preload) opens its own
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db_pid = os.getpid()
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT, state TEXT, stage TEXT, "
+                "error TEXT, submitted REAL, finished REAL, "
+                "cancel INTEGER DEFAULT 0, result BLOB)"
+            )
+            self.db.commit()
+        return self.db
+
+    def _execute(self, query, params=()):
+        with self.lock:
+            db = self._connect()
+            cursor = db.execute(query, params)
+            db.commit()
+            return cursor
+
+    def add(self, job_id, kind):
+        self._execute(
+            "INSERT INTO jobs (id, kind, state, submitted) VALUES (?, ?, 'pending', ?)",
+            (job_id, kind, time.time()),
+        )
+
+    def get(self, job_id, *fields):
+        """Fields of a job, None if there is no such job."""
+        with self.lock:
+            return (
+                self._connect()
+                .execute(
+                    f"SELECT {', '.join(fields)} FROM jobs WHERE id = ?", (job_id,)
+                )
+                .fetchone()
+            )
+
+    def move(self, job_id, states, state, **fields):
+        """
+        Put a job in state if it is in one of states.
+
+        :return: whether the job was moved
+        """
+        assignments = "".join(f", {field} = ?" for field in fields)
+        cursor = self._execute(
+            f"UPDATE jobs SET state = ?{assignments} WHERE id = ? AND state IN "
+            f"({', '.join('?' * len(states))})",
+            (state, *fields.values(), job_id, *states),
+        )
+        return cursor.rowcount > 0
+
+    def set(self, job_id, **fields):
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        self._execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+        )
+
+    def purge(self, ttl):
+        self._execute("DELETE FROM jobs WHERE finished < ?", (time.time() - ttl,))
+
+
+store = JobStore(JOB_DB)
+
+# In a job process: id of the job being run
+_running = None
+
+
+def report_stage(stage):
+    """
+    Record the stage the running job reached, outside of jobs this does nothing.
+
+    :raises JobCancelled: if the job was cancelled in the meantime
+    """
+    if _running is None:
+        return
+    if store.get(_running, "cancel")[0]:
+        raise JobCancelled(_running)
+    store.set(_running, stage=stage)
+
+
+def _run(kind, body, job_id):
+    global _running
+    if not store.move(job_id, ("pending",), "running"):
+        return  # cancelled before it started
+    module, function, _ = JOB_KINDS[kind]
+    if kind == "refish-board" and body["transducer"] == "internal":
+        del body["transducer"]
+
+    _running = job_id
+    try:
+        result = getattr(importlib.import_module(module), function)(body)
+        report_stage("serializing")
+        result = json.dumps(result, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
+    except JobCancelled:
+        store.move(job_id, ("running",), "cancelled", finished=time.time())
+        return
+    except Exception as e:
+        store.move(
+            job_id,
+            ("running",),
+            "failed",
+            error=str(e) or type(e).__name__,
+            finished=time.time(),
+        )
+        raise
+    finally:
+        _running = None
+    store.move(job_id, ("running",), "done", result=result, finished=time.time())
+
+
+class JobManager(object):
+    """
+    Jobs submitted to a process pool of this worker, recorded in the job store
+    until JOB_TTL after they finish.
+    """
+
+    def __init__(self, processes, ttl, store):
+        self.processes = processes
+        self.ttl = ttl
+        self.store = store
+        self.futures = {}  # id -> Future, for the jobs this worker submitted
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def _start(self):
+        if self.pool is None:
+            # spawn rather than fork, as forking while another thread holds
+            # foma's compile lock would leave the child waiting on it forever
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    def submit(self, kind, body):
+        """Start a job, returning its id."""
+        job_id = uuid.uuid4().hex
+        self.store.purge(self.ttl)
+        self.store.add(job_id, kind)
+        with self.lock:
+            self._start()
+            future = self.futures[job_id] = self.pool.submit(_run, kind, body, job_id)
+        future.add_done_callback(lambda future: self._finished(job_id, future))
+        eprint(f"Job {job_id} ({kind}) submitted")
+        return job_id
+
+    def _finished(self, job_id, future):
+        with self.lock:
+            self.futures.pop(job_id, None)
+        if future.cancelled():
+            self.store.move(job_id, ("pending",), "cancelled", finished=time.time())
+        elif future.exception() is not None:
+            # the job process died before it could record the failure
+            self.store.move(
+                job_id,
+                ("pending", "running"),
+                "failed",
+                error=str(future.exception()) or type(future.exception()).__name__,
+                finished=time.time(),
+            )
+
+    def status(self, job_id):
+        """
+        Status of a job.
+
+        :return: {"id", "kind", "state", "stage", "error", "submitted", "finished"}
+                 where state is one of pending, running, done, failed, cancelled
+                 and stage the last of STAGES the job reached
+        """
+        fields = ("id", "kind", "state", "stage", "error", "submitted", "finished")
+        self.store.purge(self.ttl)
+        row = self.store.get(job_id, *fields)
+        if row is None:
+            raise UnknownJob(job_id)
+        return dict(zip(fields, row))
+
+    def result(self, job_id):
+        """
+        Serialized result of a finished job, None while it runs.
+
+        :raises JobCancelled: if the job was cancelled
+        :raises JobFailed: if the job failed
+        """
+        self.store.purge(self.ttl)
+        row = self.store.get(job_id, "state", "error", "result")
+        if row is None:
+            raise UnknownJob(job_id)
+        state, error, result = row
+        if state == "cancelled":
+            raise JobCancelled(job_id)
+        if state == "failed":
+            raise JobFailed(error)
+        if state != "done":
+            return None
+        return bytes(result)
+
+    def cancel(self, job_id):
+        """Cancel a job; a running job stops at its next stage."""
+        self.status(job_id)
+        with self.lock:
+            future = self.futures.get(job_id)
+        if future is not None:
+            future.cancel()
+        # a job that has not started is cancelled at once, a running one sees
+        # the flag at its next stage
+        if not self.store.move(job_id, ("pending",), "cancelled", finished=time.time()):
+            self.store.set(job_id, cancel=1)
+        return self.status(job_id)
+
+
+jobs = JobManager(JOB_PROCESSES, JOB_TTL, store)
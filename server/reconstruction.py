@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# Inferring the reconstruction of a cognate set
+#
+# Each member of a cognate set (a doculect, or a column of a board) supports
+# the set of reconstructions its forms go back to. The cognate set is
+# reconstructed to what every member supports (strict), or failing that to
+# what at least two members support (lenient), i.e. the union of the
+# intersections of every pair of members. Both are read off one count of
+# supporting members per reconstruction, so the work is linear in the number
+# of reconstructions rather than quadratic in the number of members.
+#
+# Usage:
+#   infer_reconstructions([{"ka", "ga"}, {"ka"}, {"ga", "ka"}])  # (["ka"], True)
+#   infer_reconstructions([{"ka"}, {"ga"}, {"ga"}])  # (["ga"], False)
+
+from collections import Counter
+
+
+def support_counts(reconstruction_sets):
+    """
+    Number of members supporting each reconstruction.
+
+    :param reconstruction_sets: iterable of sets of reconstructions, one per member
+    :return: (Counter of reconstruction → supporting members, number of members)
+    """
+    support = Counter()
+    members = 0
+    for reconstructions in reconstruction_sets:
+        support.update(reconstructions)
+        members += 1
+    return support, members
+
+
+def infer_reconstructions(reconstruction_sets):
+    """
+    Strict or lenient reconstructions of a cognate set.
+
+    :param reconstruction_sets: iterable of sets of reconstructions, one per member
+    :return: (reconstructions, strict) where reconstructions is the sorted list
+             of those supported by every member if there are any (strict is
+             True), otherwise of those supported by at least two members
+             (strict is False). Without members, this is ([], True).
+    """
+    support, members = support_counts(reconstruction_sets)
+    strict = sorted(rec for rec, count in support.items() if count == members)
+    if strict or not members:
+        return strict, True
+    return sorted(rec for rec, count in support.items() if count >= 2), False
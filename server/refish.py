@@ -134,17 +134,22 @@ def back_reconstruct_list(syllable_ids, fsts, words):
     at_least_one = False
     first_form = False
 
+    syllables = []
     for syllable_id in syllable_ids:
         word_id, _, n = syllable_id.rpartition("-")
         n = int(n)
-        ipa = words[word_id]["syllables"][n]
-        doculect = words[word_id]["doculect"]
+        syllables.append((words[word_id]["doculect"], words[word_id]["syllables"][n]))
+    # Reconstruct the whole list at once, with one applyer per doculect
+    recs_of_syl = apply_up_by_doculect(
+        fsts, [(doculect, replace_diacritics_up(ipa)) for doculect, ipa in syllables]
+    )
 
+    for doculect, ipa in syllables:
         if not first_form:
             first_form = ipa
         if doculect in fsts:
-            the_syl = replace_diacritics(ipa)
-            rec = list(fsts[doculect].apply_up(the_syl))
+            the_syl = replace_diacritics_up(ipa)
+            rec = list(recs_of_syl[doculect][the_syl])
             if rec:
                 # only record reconstructions when something *is* reconstructed
                 at_least_one = True
@@ -157,23 +162,9 @@ def back_reconstruct_list(syllable_ids, fsts, words):
     inferred_reconstructions = []
 
     if at_least_one:
-        strict = True
-        inferred_reconstructions = list(set.intersection(*reconsts.values()))
-
-        if not inferred_reconstructions:
-            strict = False
-            # kinda lenient way of generating reconstructions
-            # try and make intersection of every pair of doculects
-            pairwise_intersections = [
-                set.intersection(reconsts[a], reconsts[b])
-                for a in reconsts
-                for b in reconsts
-                if a != b
-            ]
-            if pairwise_intersections:
-                inferred_reconstructions = list(set.union(*pairwise_intersections))
-            else:
-                inferred_reconstructions = []
+        # the intersection of all doculects, or if empty, the kinda lenient
+        # union of the intersections of every pair of doculects
+        inferred_reconstructions, strict = infer_reconstructions(reconsts.values())
 
     return (inferred_reconstructions, strict)
 
@@ -183,156 +174,254 @@ def back_reconstruct_list(syllable_ids, fsts, words):
 import argparse
 
 # Compile transducers
-from foma import FST
-import tempfile
-import os
-import subprocess
+from fst_cache import compile_transducer
+from apply_cache import apply_up_by_doculect
+from reconstruction import infer_reconstructions
 
 from disjointset import DisjointSet
+from jobs import report_stage
 
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of processes reconstructing the columns of large boards
+REFISH_PROCESSES = int(os.environ.get("CAPR_REFISH_PROCESSES", os.cpu_count() or 1))
+# Boards with fewer columns are reconstructed in the calling process
+REFISH_PARALLEL_MIN = int(os.environ.get("CAPR_REFISH_PARALLEL_MIN", 2000))
+
+
+# Networks of the given doculects among compiled networks
+def fsts_of_doculects(networks, doculects):
+    return {
+        doculect_name: networks[fst_index[doculect_name]]
+        for doculect_name in doculects
+        if fst_index[doculect_name] in networks
+    }
+
+
+# Compile a transducer and keep the networks of the given doculects
+def load_fsts(new_transducer, doculects):
+    eprint("Compiling FSTs (new)")
+    networks, _ = compile_transducer(new_transducer)
+    fsts_new = fsts_of_doculects(networks, doculects)
+    eprint("FSTs loaded:", ", ".join(fsts_new))
+    return fsts_new
+
+
+# Reconstructions of the syllables of columns, round one of refishing
+# columns: {column_id: column}, only these columns are reconstructed
+# input_syllables: {syllable_id: syllable} as sent by the interface
+# report: whether to print the columns sharing a strict etymon
+# Return values: (reconsts_of_column, first_form_of_column) where
+# reconsts_of_column[column_id][doculect] are the reconstructions of the
+# column's syllables in that doculect, and first_form_of_column[column_id] is
+# any daughter-language form of the column, so as to provide a board title in
+# the case of no available reconstruction
+def first_round(columns, input_syllables, fsts_new, report=False):
+    ### FIRST ROUND FISHING
+    # Use strict cognacy-semantic relations to merge columns together
+    # If two columns share something with the same reconstruction & same glossid, they should be merged tout court
 
-def refish(jsonfile, csvfile="lexicon.tsv", fstfile="refishing-fst2.txt"):
-    # Board from JSON
-    script_path = os.path.dirname(os.path.realpath(__file__))
+    # We first use a disjoint set to compute the transitive closure of the relationship "share a strict etymon somehow not recognized by lingpy"
+    ds_round1 = DisjointSet(columns)
+    first_column_of_gr = {}  # ids of columns, indexed by (glossid, reconstruction)
+    merged = []  # pairs of ids of columns sharing a strict etymon
+
+    # Reconstruct every syllable of the board at once, with one applyer per
+    # doculect; both rounds read the results from the tables filled below
+    recs_of_syl = apply_up_by_doculect(
+        fsts_new,
+        [
+            (s["doculect"], replace_diacritics_up(s["syllable"]))
+            for column in columns.values()
+            for s in (
+                input_syllables[syllable_id] for syllable_id in column["syllableIds"]
+            )
+        ],
+    )
+    # reconsts_of_column[column_id][doculect] → reconstructions of its syllables
+    reconsts_of_column = {}
+    first_form_of_column = {}
 
-    fsts_new = {}
-    new_transducer = ""
+    # We process each cognate set with ID "column_id"
+    for column_id in columns:
+        column_number = ds_round1.id(column_id)
+        reconsts = reconsts_of_column[column_id] = {}  # indexed by doculect
+        first_form_of_column[column_id] = False
 
-    eprint("Processing json input...")
-    if isinstance(jsonfile, dict):
-        eprint("Parsing board as inputted JSON")
+        syllables = [
+            input_syllables[syllable_id]
+            for syllable_id in columns[column_id]["syllableIds"]
+        ]
 
-        if "transducer" in jsonfile:
-            eprint("Using user provided transducer")
-            new_transducer = jsonfile["transducer"]
-        else:
-            eprint("Using default transducer")
-            with open(fstfile) as fst_file:
-                new_transducer = fst_file.read()
+        for syllable in syllables:
+            if not first_form_of_column[column_id]:
+                first_form_of_column[column_id] = syllable["syllable"]
 
-        input_board = jsonfile
-    else:
-        eprint("Parsing board as file")
-        input_board = json.load(open(jsonfile, "r+"))
+            if syllable["doculect"] in fsts_new:
+                the_syl = replace_diacritics_up(syllable["syllable"])
+                reconstructions = list(recs_of_syl[syllable["doculect"]][the_syl])
+                if reconstructions:
+                    # Add the reconstruction to that of other word-forms in the same language reconstructed to the same root
+                    reconsts.setdefault(syllable["doculect"], set()).update(
+                        reconstructions
+                    )
+                for rec in reconstructions:
+                    if (rec, syllable["glossid"]) not in first_column_of_gr:
+                        first_column_of_gr[(rec, syllable["glossid"])] = column_number
+                    else:
+                        merged.append(
+                            (
+                                first_column_of_gr[(rec, syllable["glossid"])],
+                                column_number,
+                            )
+                        )
 
-        # Read and compile the FST
-        with open(fstfile) as fst_file:
-            new_transducer = fst_file.read()
+    if not report:
+        # the grouping is only used for the report
+        return reconsts_of_column, first_form_of_column
 
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        os.chdir(tmpdirname)
-        eprint("Compiling FSTs (new)")
-        with open("transducer.foma", "w") as fp:
-            fp.write(new_transducer)
-        output = subprocess.check_output(["foma", "-f", "transducer.foma"]).decode(
-            "UTF-8"
-        )
-        eprint("\n".join(output.split("\n")[-5:]))
-        for doculect_name in input_board["fstDoculects"]:
-            if os.path.isfile(fst_index[doculect_name] + ".bin"):
-                fsts_new[doculect_name] = FST.load(fst_index[doculect_name] + ".bin")
-        os.chdir(script_path)
-        eprint("FSTs loaded:", ", ".join(fsts_new))
+    ds_round1.union_many(merged)
+    groups = ds_round1.groups()
+    for equivclass_id in groups:
+        group = sorted(groups[equivclass_id])
+        # how to merge columns? Simple: be conservative, don't merge them
+        if len(group) > 1:
+            eprint(group)
+            for col in group:
+                # prepare a report
+                report_lines = []
+                for syl_id in columns[col]["syllableIds"]:
+                    syl = input_syllables[syl_id]
+                    report_lines.append(syl["glossid"] + syl["syllable"])
+                eprint(", ".join(report_lines))
 
-    # read the word CSV
-    input_syllables = input_board["syllables"]
+    return reconsts_of_column, first_form_of_column
 
-    # import fileinput
-    def process_row(row):
-        if row["ID"].startswith("#"):
-            # internal to lingpy
-            return
 
-        word_id = "word-" + row["ID"]
-        sylls = syllabize(row["IPA"])
+# Reconstruction of a column, from the reconstructions of its syllables
+# Return value: (column_reconstructions, strict, sortkey, clean)
+def analyse_column(reconsts, first_form):
+    strict = True
+    column_reconstructions = []
 
-        # Now we can loop on each syllable in the language
-        for syl in range(len(sylls)):
-            # Put new information into crossid data
-            syllable_id = word_id + "-" + str(syl)
-            syllable_row = {
-                "id": syllable_id,
-                "doculect": row["DOCULECT"],
-                "syllable": sylls[syl],
-                "glossid": row["GLOSSID"],
-            }
-            input_syllables[syllable_id] = syllable_row
+    # at least one syllable-form in the cognate set has a reconstruction
+    if reconsts:
+        # first, try an intersection of 'em all together
+        # if this doesn't work, at least one lg WITH reconstruction refuse to adopt to the common reconstruction
+        # so fall back to the kinda lenient union of the intersections of every pair of doculects
+        column_reconstructions, strict = infer_reconstructions(reconsts.values())
 
-    # with open(fstfile) as csv_file:
-    #     csvreader = csv.DictReader(
-    #         filter(lambda row: row.strip() and row[0] != "#", open(csvfile, "r")),
-    #         dialect="excel-tab",
-    #     )
-    #     eprint("Processing TSV rows...")
-    #     words = {}
-    #     for row in csvreader:
-    #         process_row(row)
+        # add some asterisks for fun
+        column_reconstructions = ["*" + w for w in column_reconstructions]
 
-    old_columns = input_board["columns"]
-    old_boards = input_board["boards"]
+    # Now "column_reconstructions" contains a reasonable guess for what should be reconstructed to this cognate set
+    if column_reconstructions:
+        sortkey = (0, column_reconstructions[0])
+    else:
+        sortkey = (1, str(first_form))
 
-    json_boards = {}  # new ones to be produced
+    # Compute reliability
+    # Reliable := reconstruction present and based on more than one language
+    clean = bool(column_reconstructions) and len(reconsts) > 1
 
-    # Before we begin, it's useful to compile a reverse index, detailing to which board a certain column belongs in the old
-    old_board_of_column = dict()
-    new_board_of_column = dict()
+    return column_reconstructions, strict, sortkey, clean
 
-    for board_id in old_boards:
-        for column_id in old_boards[board_id]["columnIds"]:
-            old_board_of_column[column_id] = board_id
 
-    # Let's try and take a look at the whole thing first
-    # json.dump(old_board_of_column, sys.stdout, indent=2)
+# Both rounds of refishing for the given columns, up to their reconstruction
+# Return value: {column_id: analyse_column(...)}
+def analyse_columns(columns, input_syllables, fsts_new, report=False):
+    reconsts_of_column, first_form_of_column = first_round(
+        columns, input_syllables, fsts_new, report
+    )
+    return {
+        column_id: analyse_column(
+            reconsts_of_column[column_id], first_form_of_column[column_id]
+        )
+        for column_id in columns
+    }
+
+
+# Pool of processes reconstructing columns, started on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def refish_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork, as forking while another thread holds
+            # foma's compile lock would leave the child waiting on it forever
+            _pool = ProcessPoolExecutor(
+                max_workers=REFISH_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _pool
+
+
+# analyse_columns in a pool process, which loads the networks from the
+# compiled transducer cache rather than receiving them
+def analyse_chunk(transducer, doculects, columns, input_syllables):
+    networks, _ = compile_transducer(transducer)
+    return analyse_columns(
+        columns, input_syllables, fsts_of_doculects(networks, doculects)
+    )
 
-    ### FIRST ROUND FISHING
-    # Use strict cognacy-semantic relations to merge columns together
-    # If two columns share something with the same reconstruction & same glossid, they should be merged tout court
 
-    # We first use a disjoint set to compute the transitive closure of the relationship "share a strict etymon somehow not recognized by lingpy"
-    ds_round1 = DisjointSet()
-    first_column_of_gr = {}  # indexed by (glossid, reconstruction)
+# analyse_columns on the processes of refish_pool, for large boards
+# Columns are reconstructed independently of each other (only the boards
+# depend on several), so they are split into contiguous chunks, each sent
+# with the syllables of its columns
+# Return value: {column_id: analyse_column(...)}, in the order of columns
+def analyse_columns_parallel(columns, input_syllables, transducer, doculects):
+    column_ids = list(columns)
+    n_chunks = min(len(column_ids), REFISH_PROCESSES * 4)
+    futures = []
+    for k in range(n_chunks):
+        chunk = {
+            column_id: columns[column_id]
+            for column_id in column_ids[
+                k * len(column_ids) // n_chunks : (k + 1) * len(column_ids) // n_chunks
+            ]
+        }
+        chunk_syllables = {
+            syllable_id: input_syllables[syllable_id]
+            for column in chunk.values()
+            for syllable_id in column["syllableIds"]
+        }
+        futures.append(
+            refish_pool().submit(
+                analyse_chunk, transducer, doculects, chunk, chunk_syllables
+            )
+        )
+    eprint(f"Reconstructing {len(column_ids)} columns in {n_chunks} chunks")
 
-    # We process each cognate set with ID "column_id"
-    for column_id in input_board["columns"]:
-        ds_round1.add(column_id, column_id)
+    analyses = {}
+    for future in futures:
+        analyses.update(future.result())
+    return analyses
 
-        for syllable_id in input_board["columns"][column_id]["syllableIds"]:
-            syllable = input_syllables[syllable_id]
-            if syllable["doculect"] in fsts_new:
-                the_syl = replace_diacritics_up(syllable["syllable"])
-                reconstructions = list(fsts_new[syllable["doculect"]].apply_up(the_syl))
-                for rec in reconstructions:
-                    if (rec, syllable["glossid"]) not in first_column_of_gr:
-                        first_column_of_gr[(rec, syllable["glossid"])] = column_id
-                    else:
-                        ds_round1.add(
-                            first_column_of_gr[(rec, syllable["glossid"])], column_id
-                        )
 
-    equivclasses = ds_round1.group.keys()
-    for equivclass_id in equivclasses:
-        columns = sorted(ds_round1.group[equivclass_id])
-        # how to merge columns? Simple: be conservative, don't merge them
-        if len(columns) > 1:
-            if not production:
-                eprint(columns)
-            for col in columns:
-                # prepare a report
-                report = []
-                for syl_id in old_columns[col]["syllableIds"]:
-                    syl = input_syllables[syl_id]
-                    report.append(syl["glossid"] + syl["syllable"])
-                if not production:
-                    eprint(", ".join(report))
+# Group columns sharing a reconstruction into boards, round two of refishing
+# input_columns: {column_id: column}, updated in place with the refishing status
+# old_boards: {board_id: board} the columns were on before refishing
+# analyses: {column_id: analyse_column(...)} for every column of input_columns
+# Return values: (input_columns, json_boards, new_board_of_column)
+def build_boards(input_columns, old_boards, analyses):
+    json_boards = {}  # new ones to be produced
 
-    new_columns = {}
-    new_column_of_old_column = {}
+    # Before we begin, it's useful to compile a reverse index, detailing to which board a certain column belongs in the old
+    old_board_of_column = dict()
+    new_board_of_column = dict()
 
-    # TODO: not done yet, so restore input_columns for now
-    input_columns = old_columns
+    for board_id in old_boards:
+        for column_id in old_boards[board_id]["columnIds"]:
+            old_board_of_column[column_id] = board_id
 
     ### SECOND ROUND FISHING
-    # TODO: need to work on new_columns instead of whatever it works on
     # use the new transducers to unite the cognate sets into boards
     reconstructions_of_column = {}
     strictness_of_column = {}
@@ -341,97 +430,45 @@ def refish(jsonfile, csvfile="lexicon.tsv", fstfile="refishing-fst2.txt"):
     sortkey_of_column = {}
     included_in_clean = set([])
 
-    # ds holds the merging relationship of columns
-    ds = DisjointSet()
+    # ds holds the merging relationship of columns, merged holds the pairs of
+    # ids of columns sharing a reconstruction
+    ds = DisjointSet(input_columns)
+    merged = []
 
     # We process each cognate set with ID "column_id"
-    for column_id in input_board["columns"]:
-        reconsts = {}  # indexed by doculect
-        at_least_one = False
-        first_form = False  # will contain any daughter-language form, so as to provide a board title in the case of no available reconstruction
-
-        for syllable_id in input_board["columns"][column_id]["syllableIds"]:
-            syllable = input_syllables[syllable_id]
+    for column_id in input_columns:
+        column_reconstructions, strict, sortkey, clean = analyses[column_id]
 
-            if not first_form:
-                first_form = syllable["syllable"]
-
-            if syllable["doculect"] in fsts_new:
-                the_syl = replace_diacritics_up(syllable["syllable"])
-                rec = list(fsts_new[syllable["doculect"]].apply_up(the_syl))
-
-                if rec:
-                    # Now at least one syllable-form in the cognate set has a reconstruction!
-                    at_least_one = True
-                    # Add the reconstruction to that of other word-forms in the same language reconstructed to the same root
-                    if syllable["doculect"] not in reconsts:
-                        reconsts[syllable["doculect"]] = set(rec)
-                    else:
-                        reconsts[syllable["doculect"]] = reconsts[
-                            syllable["doculect"]
-                        ].union(set(rec))
-
-        strict = True
-        column_reconstructions = []
-
-        if at_least_one:
-            strict = True
-            # first, try an intersection of 'em all together
-            column_reconstructions = list(set.intersection(*reconsts.values()))
-            # if this doesn't work, at least one lg WITH reconstruction refuse to adopt to the common reconstruction
-            if not column_reconstructions:
-                strict = False
-                # kinda lenient way of generating reconstructions
-                # the union of the intersections of every pair of doculects
-                pairwise_intersections = [
-                    set.intersection(reconsts[a], reconsts[b])
-                    for a in reconsts
-                    for b in reconsts
-                    if a != b
-                ]
-                if pairwise_intersections:
-                    column_reconstructions = list(set.union(*pairwise_intersections))
-                else:
-                    column_reconstructions = []
-
-            # add some asterisks for fun
-            column_reconstructions = ["*" + w for w in column_reconstructions]
-
-        # Now "column_reconstructions" contains a reasonable guess for what should be reconstructed to this cognate set, put them into the global variables
+        # Put the reconstructions into the global variables
         reconstructions_of_column[column_id] = column_reconstructions
         strictness_of_column[column_id] = strict
-        if column_reconstructions:
-            sortkey_of_column[column_id] = (0, column_reconstructions[0])
-        else:
-            sortkey_of_column[column_id] = (1, str(first_form))
+        sortkey_of_column[column_id] = sortkey
 
         # Merge with every cognate set that share at least one reconstruction
-        ds.add(column_id, column_id)
         for reconst in column_reconstructions:
             if reconst not in first_column_of_reconstruction:
-                first_column_of_reconstruction[reconst] = column_id
+                first_column_of_reconstruction[reconst] = ds.id(column_id)
             else:
-                ds.add(first_column_of_reconstruction[reconst], column_id)
+                merged.append(
+                    (first_column_of_reconstruction[reconst], ds.id(column_id))
+                )
 
-        # Compute reliability
-        # Reliable := reconstruction present and based on more than one language
-        if column_reconstructions and len(reconsts) > 1:
+        if clean:
             included_in_clean.add(column_id)
 
     # Sort crossids according to reconstruction / form
     # taken from ds
-    equivclasses = sorted(
-        ds.group.keys(), key=lambda column_id: sortkey_of_column[column_id]
-    )
+    ds.union_many(merged)
+    groups = ds.groups()
+    equivclasses = sorted(groups, key=lambda column_id: sortkey_of_column[column_id])
 
     created_board_counter = 1
 
     # Second round: print the actual content from display_crossids
-    # TODO: need to work on new_columns instead of whatever it works on
     ## Takes the list of grouped columns, decides whether to make a board, then names the board.
     for equivclass_id in equivclasses:
         # get columns in the equivalent class
-        columns = sorted(ds.group[equivclass_id])
+        columns = sorted(groups[equivclass_id])
 
         # get strictness and cleanness
         strict = all([strictness_of_column[col] for col in columns])
@@ -451,19 +488,8 @@ def refish(jsonfile, csvfile="lexicon.tsv", fstfile="refishing-fst2.txt"):
 
         # Now, compute a board title
         all_reconstructions = [set(reconstructions_of_column[col]) for col in columns]
-        reconstructions = list(set.intersection(*all_reconstructions))
-        if not reconstructions:
-            strict = False
-            pairwise_intersections = [
-                set.intersection(all_reconstructions[a], all_reconstructions[b])
-                for a in range(len(all_reconstructions))
-                for b in range(len(all_reconstructions))
-                if a != b
-            ]
-            if pairwise_intersections:
-                reconstructions = list(set.union(*pairwise_intersections))
-            else:  # impossible
-                reconstructions = []
+        reconstructions, strict_title = infer_reconstructions(all_reconstructions)
+        strict = strict and strict_title
 
         if not reconstructions:
             board_title = "*???"
@@ -481,8 +507,6 @@ def refish(jsonfile, csvfile="lexicon.tsv", fstfile="refishing-fst2.txt"):
         }
         json_boards[board_id] = board_json
 
-    json_current_board = "board-1"
-
     # Reboarding status & last resource conservative reboarding
     for column_id in list(input_columns.keys()):
         if not input_columns[column_id]["syllableIds"]:
@@ -523,5 +547,106 @@ def refish(jsonfile, csvfile="lexicon.tsv", fstfile="refishing-fst2.txt"):
             if "refishingStatus" in input_columns[column_id]:
                 del input_columns[column_id]["refishingStatus"]
 
+    return input_columns, json_boards, new_board_of_column
+
+
+# Transducer used when the request does not provide one
+DEFAULT_FST = "refishing-fst2.txt"
+
+
+def refish(jsonfile, csvfile="lexicon.tsv", fstfile=DEFAULT_FST):
+    # Board from JSON
+    new_transducer = ""
+
+    eprint("Processing json input...")
+    if isinstance(jsonfile, dict):
+        eprint("Parsing board as inputted JSON")
+
+        if "transducer" in jsonfile:
+            eprint("Using user provided transducer")
+            new_transducer = jsonfile["transducer"]
+        else:
+            eprint("Using default transducer")
+            with open(fstfile) as fst_file:
+                new_transducer = fst_file.read()
+
+        input_board = jsonfile
+    else:
+        eprint("Parsing board as file")
+        input_board = json.load(open(jsonfile, "r+"))
+
+        # Read and compile the FST
+        with open(fstfile) as fst_file:
+            new_transducer = fst_file.read()
+
+    # read the word CSV
+    input_syllables = input_board["syllables"]
+
+    # import fileinput
+    def process_row(row):
+        if row["ID"].startswith("#"):
+            # internal to lingpy
+            return
+
+        word_id = "word-" + row["ID"]
+        sylls = syllabize(row["IPA"])
+
+        # Now we can loop on each syllable in the language
+        for syl in range(len(sylls)):
+            # Put new information into crossid data
+            syllable_id = word_id + "-" + str(syl)
+            syllable_row = {
+                "id": syllable_id,
+                "doculect": row["DOCULECT"],
+                "syllable": sylls[syl],
+                "glossid": row["GLOSSID"],
+            }
+            input_syllables[syllable_id] = syllable_row
+
+    # with open(fstfile) as csv_file:
+    #     csvreader = csv.DictReader(
+    #         filter(lambda row: row.strip() and row[0] != "#", open(csvfile, "r")),
+    #         dialect="excel-tab",
+    #     )
+    #     eprint("Processing TSV rows...")
+    #     words = {}
+    #     for row in csvreader:
+    #         process_row(row)
+
+    result, _, _ = refish_board(input_board, new_transducer)
+    return result
+
+
+# Refish a board with a transducer
+# Return values: (result, fsts_new, analyses) where result is
+# {"columns", "boards"} as returned by refish, and analyses are the
+# reconstructions of its columns, from analyse_columns
+def refish_board(input_board, new_transducer):
+    report_stage("compiling")
+    fsts_new = load_fsts(new_transducer, input_board["fstDoculects"])
+    report_stage("reconstructing")
+    if (
+        production
+        and REFISH_PROCESSES > 1
+        and len(input_board["columns"]) >= REFISH_PARALLEL_MIN
+    ):
+        analyses = analyse_columns_parallel(
+            input_board["columns"],
+            input_board["syllables"],
+            new_transducer,
+            input_board["fstDoculects"],
+        )
+    else:
+        analyses = analyse_columns(
+            input_board["columns"],
+            input_board["syllables"],
+            fsts_new,
+            report=not production,
+        )
+    report_stage("grouping")
+    input_columns, json_boards, _ = build_boards(
+        input_board["columns"], input_board["boards"], analyses
+    )
+
     eprint("Successful refishing.")
-    return {"columns": input_columns, "boards": json_boards}
+    return {"columns": input_columns, "boards": json_boards}, fsts_new, analyses
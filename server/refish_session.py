@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# Incremental refishing from a log of board edits
+#
+# A full refish (/refish-board) opens a session that keeps the transducer, the
+# syllables, the refished columns and boards and the reconstruction of every
+# column. Later refishes of the same board (/refish-edits) only send what the
+# user changed since, as a list of edits:
+#
+#   {"op": "column", "columnId": ..., "column": {...}}   add or replace a column
+#   {"op": "delete-column", "columnId": ...}
+#   {"op": "board", "boardId": ..., "board": {...}}      add or replace a board
+#   {"op": "delete-board", "boardId": ...}
+#
+# Only the columns whose syllables changed go through the transducer again;
+# the boards are then regrouped from the kept reconstructions, exactly as a full
+# refish of the edited board would. The response is a patch of the columns and
+# boards that differ from the client's (edited) board.
+#
+# Sessions live in the memory of the worker that opened them, with
+# least-recently-used eviction. A request for an unknown session, or with a
+# different transducer, should fall back to a full refish.
+
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+from board_store import apply_edits
+from fst_cache import script_hash
+from refish import DEFAULT_FST, analyse_columns, build_boards, refish_board
+
+# Number of refish sessions kept per worker
+REFISH_SESSIONS = int(os.environ.get("CAPR_REFISH_SESSIONS", 8))
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class UnknownSession(KeyError):
+    """The session expired, was opened by another worker or never existed."""
+
+
+class TransducerChanged(ValueError):
+    """The edits are for another transducer than the session's."""
+
+
+class RefishSession(object):
+    """State of the last refish of a board."""
+
+    def __init__(self, transducer_hash, fsts, syllables, columns, boards, analyses):
+        self.transducer_hash = transducer_hash
+        self.fsts = fsts
+        self.syllables = syllables
+        self.columns = columns
+        self.boards = boards
+        self.analyses = analyses  # column_id -> analyse_column(...)
+        self.lock = threading.Lock()
+
+
+class RefishSessions(object):
+    """LRU store of refish sessions, by session id."""
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            if session_id not in self.sessions:
+                raise UnknownSession(session_id)
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+
+    def add(self, session):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = session
+            while len(self.sessions) > max(self.max_sessions, 1):
+                self.sessions.popitem(last=False)
+        return session_id
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+
+sessions = RefishSessions(REFISH_SESSIONS)
+
+
+def transducer_text(input_board):
+    """Transducer of a refish request, the default one without "transducer"."""
+    if "transducer" in input_board:
+        return input_board["transducer"]
+    with open(DEFAULT_FST) as fst_file:
+        return fst_file.read()
+
+
+def refish_with_session(input_board):
+    """
+    Refish a whole board, as refish, and open a session for later edits.
+
+    :return: {"session", "columns", "boards"}
+    """
+    transducer = transducer_text(input_board)
+    result, fsts, analyses = refish_board(input_board, transducer)
+    session = RefishSession(
+        script_hash(transducer),
+        fsts,
+        input_board["syllables"],
+        result["columns"],
+        result["boards"],
+        analyses,
+    )
+    return {"session": sessions.add(session), **result}
+
+
+def refish_edits(session_id, edits, transducer):
+    """
+    Refish the board of a session after edits.
+
+    :param session_id: id returned by refish_with_session
+    :param edits: edit operations, in the order they were made
+    :param transducer: text of the transducer, which must be the session's
+    :return: {"session", "columns", "boards", "deletedColumns", "deletedBoards"}
+             with the columns and boards that changed, and the ids of those
+             that were removed
+    """
+    session = sessions.get(session_id)
+    with session.lock:
+        if script_hash(transducer) != session.transducer_hash:
+            raise TransducerChanged(session_id)
+
+        columns = session.columns
+        boards = session.boards
+        touched = apply_edits(columns, boards, edits)
+
+        # Reconstruct the columns the edits touched, keep the others
+        for column_id in touched:
+            session.analyses.pop(column_id, None)
+        session.analyses.update(
+            analyse_columns(
+                {
+                    column_id: columns[column_id]
+                    for column_id in touched
+                    if column_id in columns
+                },
+                session.syllables,
+                session.fsts,
+            )
+        )
+        eprint(f"Refishing {len(touched)} edited columns of {len(columns)}")
+
+        # what the client has, to compare the refished board with
+        old_columns = {column_id: dict(column) for column_id, column in columns.items()}
+        columns, new_boards, _ = build_boards(columns, boards, session.analyses)
+        for column_id in old_columns:
+            if column_id not in columns:
+                session.analyses.pop(column_id, None)
+        session.boards = new_boards
+
+        return {
+            "session": session_id,
+            "columns": {
+                column_id: column
+                for column_id, column in columns.items()
+                if old_columns.get(column_id) != column
+            },
+            "boards": {
+                board_id: board
+                for board_id, board in new_boards.items()
+                if boards.get(board_id) != board
+            },
+            "deletedColumns": [
+                column_id for column_id in old_columns if column_id not in columns
+            ],
+            "deletedBoards": [
+                board_id for board_id in boards if board_id not in new_boards
+            ],
+        }
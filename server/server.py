@@ -1,15 +1,26 @@
 import os
 from os.path import isfile, join
-from flask import Flask, Response, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort, g
 from flask_cors import CORS
 from functools import wraps
 from compile_lexicon_to_json import compile_to_json, compile_to_json_full_cognates
-from refish import refish
-from compare_fst import compare_fst
+from refish_session import TransducerChanged, UnknownSession, refish_edits, refish_with_session, transducer_text
+from compare_fst import compare_fst, compare_fst_records, compare_fsts, compare_fsts_records
+from board_cache import compiled_board
+from board_store import BoardChanged, UnknownBoard, board_store, patch_edits, resolve_board
+from jobs import JOB_EVENTS_TIMEOUT, JOB_KINDS, JobCancelled, UnknownJob, jobs
+from warmup import start_warm_up
 import glob
+import json
+import time
+import traceback
 
 app = Flask(__name__)
-CORS(app)
+# ETag is read by the interface to make conditional /new-board requests
+CORS(app, expose_headers=["ETag"])
+
+# Fill the caches for the default datasets and transducers
+start_warm_up()
 
 def _resp(success: bool, message: str, data: object = None):
     """
@@ -27,6 +38,22 @@ def _resp(success: bool, message: str, data: object = None):
         "data": data
     }, mimetype="application/json")
 
+def request_body():
+    """
+    Get the JSON request body, with the stored board of its boardSession
+    filled in after applying its boardEdits (see board_store)
+    """
+
+    if "body" not in g:
+        try:
+            g.body = resolve_board(request.json)
+        except UnknownBoard:
+            # 410 rather than 404, which some routes answer for other sessions
+            abort(410, "Unknown board session, upload the board again")
+        except (KeyError, ValueError) as e:
+            abort(400, f"Invalid board edit: {e}")
+    return g.body
+
 def with_json(*outer_args):
     """
     Get JSON API request body
@@ -37,10 +64,11 @@ def with_json(*outer_args):
         @wraps(func)
         def wrapper(*args, **kwargs):
             _json_body = {}
+            body = request_body()
             for arg in outer_args:
-                if not request.json:
+                if not body:
                     return _resp(False, "JSON body must not be empty")
-                val = request.json.get(arg)
+                val = body.get(arg)
                 if val != None and val != "":
                     _json_body[arg] = val
                 else:
@@ -51,6 +79,33 @@ def with_json(*outer_args):
 
     return decorator
 
+def wants_ndjson():
+    """
+    Did the client ask for a stream of JSON records?
+    """
+
+    return request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+def ndjson_response(records):
+    """
+    Stream records as they are produced, one JSON object per line, ending with
+    { type: "done", done: true }, or { type: "error", error } if producing them
+    failed, so that clients can tell a complete stream from a cut one
+    :param records: iterable of JSON-serializable records
+    """
+
+    def lines():
+        try:
+            for record in records:
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        except Exception as e:
+            traceback.print_exc()
+            yield json.dumps({"type": "error", "error": str(e) or type(e).__name__}, ensure_ascii=False) + "\n"
+            return
+        yield json.dumps({"type": "done", "done": True}) + "\n"
+
+    return Response(lines(), mimetype="application/x-ndjson")
+
 # /list-inputs returns all input file names
 @app.route("/list-inputs")
 def list_inputs():
@@ -78,10 +133,15 @@ def get_transducer(json_body):
 @app.route("/new-board", methods=["POST"])
 @with_json("dataPath", "transducer")
 def new_board(json_body):
-    if json_body["dataPath"]:
-        return compile_to_json_full_cognates(json_body["dataPath"], json_body["transducer"])
+    etag, body = compiled_board(json_body["dataPath"], json_body["transducer"])
 
-    return compile_to_json_full_cognates("./pipeline/output/germanic/stage3/germanic-aligned-final.tsv")
+    # The client already has this exact board
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
 
 # /refish-board returns the output of the refishing algorithm for cognate reassignment 
 @app.route("/refish-board", methods=["POST"])
@@ -90,13 +150,145 @@ def refish_board(json_body):
     if (json_body['transducer'] == 'internal'):
         del json_body['transducer']
 
-    board = refish(json_body)
+    # The session lets the next refish send only the edits (see /refish-edits)
+    board = refish_with_session(json_body)
+    if request_body().get("boardSession"):
+        try:
+            board_store.replace(request_body()["boardSession"], request_body()["boardVersion"],
+                                columns=board["columns"], boards=board["boards"])
+        except BoardChanged:
+            abort(409, "The board was edited while it was refished, refish it again")
     return board
 
+# /refish-edits refishes the board of a /refish-board session after the given edits,
+# returning the columns and boards that changed
+@app.route("/refish-edits", methods=["POST"])
+@with_json("session", "edits", "transducer")
+def refish_board_edits(json_body):
+    if (json_body['transducer'] == 'internal'):
+        del json_body['transducer']
+
+    try:
+        patch = refish_edits(json_body['session'], json_body['edits'], transducer_text(json_body))
+        if request_body().get("boardSession"):
+            board_store.update(request_body()["boardSession"], patch_edits(patch))
+        return patch
+    except UnknownSession:
+        abort(404, "Unknown refish session, refish the whole board")
+    except TransducerChanged:
+        abort(409, "The transducer changed, refish the whole board")
+    except (KeyError, ValueError) as e:
+        abort(400, f"Invalid edit: {e}")
+
 
 # /compare-fst returns the correspondence patterns for the transducer interface
+# With `Accept: application/x-ndjson`, they are streamed one JSON record per
+# line as they are computed: a header with the errors and missing transducers,
+# then one record per section (see compare_fst_records)
 @app.route("/compare-fst", methods=["POST"])
 @with_json("langsUnderStudy", "oldTransducer", "newTransducer", "board")
 def compare(json_body):
     print(json_body['langsUnderStudy'])
+    if wants_ndjson():
+        return ndjson_response(compare_fst_records(json_body))
     return compare_fst(json_body)
+
+# /compare-fsts compares any number of transducers side by side, streamed like /compare-fst
+@app.route("/compare-fsts", methods=["POST"])
+@with_json("langsUnderStudy", "transducers", "board")
+def compare_many(json_body):
+    print(json_body['langsUnderStudy'])
+    if wants_ndjson():
+        return ndjson_response(compare_fsts_records(json_body))
+    return compare_fsts(json_body)
+
+# /boards keeps a board on the server and returns its session; later requests can
+# send {"boardSession", "boardEdits"} in place of the columns, boards, syllables
+# and fstDoculects (or the board) of their body
+@app.route("/boards", methods=["POST"])
+@with_json("columns", "boards", "syllables", "fstDoculects")
+def upload_board(json_body):
+    return {"boardSession": board_store.create(json_body)}, 201
+
+# /boards/<session> returns the stored board, PATCH applies {"edits"} to it
+@app.route("/boards/<session_id>", methods=["GET", "PATCH"])
+def stored_board(session_id):
+    try:
+        if request.method == "PATCH":
+            if not request.json or not isinstance(request.json.get("edits"), list):
+                abort(400, "Required argument edits is not defined.")
+            version = board_store.update(session_id, request.json["edits"])
+            return {"boardSession": session_id, "version": version}
+        _, board = board_store.get(session_id)
+        return board
+    except UnknownBoard:
+        abort(404, "Unknown board session, upload the board again")
+    except (KeyError, ValueError) as e:
+        abort(400, f"Invalid board edit: {e}")
+
+# /jobs/<kind> runs /refish-board, /compare-fst or /compare-fsts in the background,
+# taking the same body, and returns the id of the job
+@app.route("/jobs/<kind>", methods=["POST"])
+def submit_job(kind):
+    if kind not in JOB_KINDS:
+        abort(404, "Unknown kind of job: " + kind)
+    _, _, required = JOB_KINDS[kind]
+    body = request_body()
+    for arg in required:
+        if not body or body.get(arg) in (None, ""):
+            abort(400, "Required argument " + arg + " is not defined.")
+    job_id = jobs.submit(kind, {arg: body[arg] for arg in required})
+    return jobs.status(job_id), 202
+
+# /jobs/<job_id> gives the state and stage of a job, DELETE cancels it
+@app.route("/jobs/<job_id>", methods=["GET", "DELETE"])
+def job_status(job_id):
+    try:
+        if request.method == "DELETE":
+            return jobs.cancel(job_id)
+        return jobs.status(job_id)
+    except UnknownJob:
+        abort(404, "Unknown or expired job")
+
+# /jobs/<job_id>/events streams the status of a job, one JSON record per line,
+# each time it changes until the job is over or JOB_EVENTS_TIMEOUT seconds have
+# passed; the client reconnects if the last status is still pending or running
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    try:
+        jobs.status(job_id)
+    except UnknownJob:
+        abort(404, "Unknown or expired job")
+
+    def events():
+        last = None
+        deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+        while True:
+            try:
+                status = jobs.status(job_id)
+            except UnknownJob:
+                return
+            if status != last:
+                yield status
+                last = status
+            if status["state"] not in ("pending", "running") or time.monotonic() > deadline:
+                return
+            time.sleep(0.5)
+
+    return ndjson_response(events())
+
+# /jobs/<job_id>/result returns the result of a finished job, as its route would
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    try:
+        body = jobs.result(job_id)
+    except UnknownJob:
+        abort(404, "Unknown or expired job")
+    except JobCancelled:
+        abort(410, "The job was cancelled")
+    except Exception as e:
+        abort(500, f"The job failed: {e}")
+    if body is None:
+        # not finished yet
+        return jobs.status(job_id), 202
+    return Response(body, mimetype="application/json")
@@ -0,0 +1,116 @@
+import apply_cache
+from apply_cache import ApplyCache
+
+
+class StubFST(object):
+    """Network reconstructing every word as its name followed by the word,
+    recording the words it is applied to."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+
+    def digest(self):
+        return "stub-" + self.name
+
+    def apply_up_many(self, words):
+        self.calls.append(("up", list(words)))
+        return {word: self._outputs(word) for word in words}
+
+    def apply_down_many(self, words):
+        self.calls.append(("down", list(words)))
+        return {word: self._outputs(word) for word in words}
+
+    def apply_up_wordlist(self, words):
+        self.calls.append(("wordlist", list(words)))
+        return {word: self._outputs(word) for word in words}
+
+    def _outputs(self, word):
+        # words starting with x have no reconstruction
+        return () if word.startswith("x") else (self.name + word,)
+
+
+def test_hits_and_misses():
+    cache = ApplyCache(100)
+    fst = StubFST("m")
+    assert cache.apply_many(fst, "up", ["pa", "ta", "pa"]) == {
+        "pa": ("mpa",),
+        "ta": ("mta",),
+    }
+    assert cache.apply_many(fst, "up", ["ta", "ka", "xa"]) == {
+        "ta": ("mta",),
+        "ka": ("mka",),
+        "xa": (),
+    }
+    assert cache.apply(fst, "up", "xa") == ()
+    # only misses are applied, each once
+    assert fst.calls == [("up", ["pa", "ta"]), ("up", ["ka", "xa"])]
+
+
+def test_keys_on_direction_and_network():
+    cache = ApplyCache(100)
+    fst, other = StubFST("m"), StubFST("b")
+    cache.apply(fst, "up", "pa")
+    cache.apply(fst, "down", "pa")
+    assert cache.apply(other, "up", "pa") == ("bpa",)
+    assert fst.calls == [("up", ["pa"]), ("down", ["pa"])]
+    # a network with the same digest shares the results
+    assert cache.apply(StubFST("m"), "up", "pa") == ("mpa",)
+
+
+def test_least_recently_used_are_evicted():
+    cache = ApplyCache(2)
+    fst = StubFST("m")
+    cache.apply(fst, "up", "pa")
+    cache.apply(fst, "up", "ta")
+    cache.apply(fst, "up", "pa")
+    cache.apply(fst, "up", "ka")
+    fst.calls = []
+    cache.apply_many(fst, "up", ["pa", "ta", "ka"])
+    assert fst.calls == [("up", ["ta"])]
+
+
+def test_large_batches_go_through_the_wordlist(monkeypatch):
+    monkeypatch.setattr(apply_cache, "APPLY_WORDLIST_MIN", 3)
+    cache = ApplyCache(100)
+    fst = StubFST("m")
+    cache.apply_many(fst, "up", ["pa", "ta"])
+    cache.apply_many(fst, "up", ["pa", "ta", "ka", "sa", "xa"])
+    # down never does
+    cache.apply_many(fst, "down", ["pa", "ta", "ka"])
+    assert fst.calls == [
+        ("up", ["pa", "ta"]),
+        ("wordlist", ["ka", "sa", "xa"]),
+        ("down", ["pa", "ta", "ka"]),
+    ]
+    assert cache.apply(fst, "up", "sa") == ("msa",)
+
+
+def test_results_survive_a_flush_and_reload(tmp_path):
+    db_path = str(tmp_path / "apply.db")
+    cache = ApplyCache(100, db_path)
+    fst = StubFST("m")
+    cache.apply_many(fst, "up", ["pa", "xa"])
+    cache.apply_many(fst, "down", ["pa"])
+    cache.flush()
+
+    reloaded = ApplyCache(100, db_path)
+    fst = StubFST("m")
+    assert reloaded.apply_many(fst, "up", ["pa", "xa", "ta"]) == {
+        "pa": ("mpa",),
+        "xa": (),
+        "ta": ("mta",),
+    }
+    assert reloaded.apply(fst, "down", "pa") == ("mpa",)
+    assert fst.calls == [("up", ["ta"])]
+
+
+def test_unflushed_results_are_not_in_the_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(apply_cache, "FLUSH_SECONDS", 3600)
+    db_path = str(tmp_path / "apply.db")
+    cache = ApplyCache(100, db_path)
+    cache.apply(StubFST("m"), "up", "pa")
+
+    fst = StubFST("m")
+    ApplyCache(100, db_path).apply(fst, "up", "pa")
+    assert fst.calls == [("up", ["pa"])]
@@ -0,0 +1,155 @@
+import pytest
+
+import board_store
+from board_store import BoardChanged, BoardStore, UnknownBoard, resolve_board
+
+
+def make_board():
+    return {
+        "columns": {
+            "column-1": {"id": "column-1", "syllableIds": ["word-1-0"]},
+            "column-2": {"id": "column-2", "syllableIds": ["word-2-0"]},
+        },
+        "boards": {"board-1": {"id": "board-1", "columnIds": ["column-1"]}},
+        "syllables": {"word-1-0": {"syllable": "pa"}},
+        "fstDoculects": {"Maru": "maru"},
+    }
+
+
+def column_edit(column_id, *syllable_ids):
+    column = {"id": column_id, "syllableIds": list(syllable_ids)}
+    return {"op": "column", "columnId": column_id, "column": column}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "boards.db")
+
+
+@pytest.fixture
+def store(db_path):
+    return BoardStore(4, db_path, 3600)
+
+
+def test_create_and_get(store):
+    session_id = store.create(make_board())
+    assert store.get(session_id) == (0, make_board())
+    with pytest.raises(UnknownBoard):
+        store.get("nope")
+
+
+def test_update_applies_edits_in_order(store):
+    session_id = store.create(make_board())
+    assert store.update(session_id, [column_edit("column-3", "word-3-0")]) == 1
+    assert (
+        store.update(
+            session_id,
+            [
+                {"op": "delete-column", "columnId": "column-2"},
+                {"op": "delete-board", "boardId": "board-1"},
+            ],
+        )
+        == 2
+    )
+    version, board = store.get(session_id)
+    assert version == 2
+    assert sorted(board["columns"]) == ["column-1", "column-3"]
+    assert board["boards"] == {}
+
+
+def test_invalid_edits_are_not_logged(store):
+    session_id = store.create(make_board())
+    for edits in ({"op": "column"}, [{"op": "move"}], [{"op": "delete-board"}]):
+        with pytest.raises(ValueError):
+            store.update(session_id, edits)
+    assert store.get(session_id)[0] == 0
+
+
+def test_boards_handed_out_never_change(store):
+    session_id = store.create(make_board())
+    _, before = store.get(session_id)
+    store.update(session_id, [{"op": "delete-column", "columnId": "column-1"}])
+    edit = column_edit("column-2", "word-9-0")
+    store.update(session_id, [edit])
+    store.replace(session_id, 2, boards={})
+    # neither the edits logged nor what was read before see the changes
+    edit["column"]["syllableIds"].append("word-8-0")
+    assert before == make_board()
+    assert store.get(session_id)[1]["columns"]["column-2"]["syllableIds"] == [
+        "word-9-0"
+    ]
+
+
+def test_replace_refuses_an_edited_board(store):
+    session_id = store.create(make_board())
+    store.update(session_id, [column_edit("column-3", "word-3-0")])
+    with pytest.raises(BoardChanged):
+        store.replace(session_id, 0, boards={})
+    store.replace(session_id, 1, boards={})
+    assert store.get(session_id) == (2, {**store.get(session_id)[1], "boards": {}})
+    with pytest.raises(BoardChanged):
+        store.replace(session_id, 1, boards={})
+
+
+def test_workers_share_boards_and_edits(db_path):
+    first = BoardStore(4, db_path, 3600)
+    second = BoardStore(4, db_path, 3600)
+    session_id = first.create(make_board())
+    second.update(session_id, [column_edit("column-3", "word-3-0")])
+    first.update(session_id, [column_edit("column-4", "word-4-0")])
+    for store in (first, second):
+        version, board = store.get(session_id)
+        assert version == 2
+        assert sorted(board["columns"]) == [
+            "column-1",
+            "column-2",
+            "column-3",
+            "column-4",
+        ]
+    # a replacement by one worker is seen by the other, and stale ones refused
+    second.replace(session_id, 2, boards={})
+    assert first.get(session_id) == (3, second.get(session_id)[1])
+    with pytest.raises(BoardChanged):
+        first.replace(session_id, 2, boards={})
+
+
+def test_evicted_boards_are_reloaded(db_path):
+    store = BoardStore(1, db_path, 3600)
+    first = store.create(make_board())
+    store.update(first, [column_edit("column-3", "word-3-0")])
+    second = store.create(make_board())
+    assert list(store.entries) == [second]
+    version, board = store.get(first)
+    assert version == 1
+    assert "column-3" in board["columns"]
+
+
+def test_expired_boards_are_purged(db_path):
+    store = BoardStore(4, db_path, -1)
+    session_id = store.create(make_board())
+    store.create(make_board())
+    store.clear()
+    with pytest.raises(UnknownBoard):
+        store.get(session_id)
+
+
+def test_resolve_board(store, monkeypatch):
+    monkeypatch.setattr(board_store, "board_store", store)
+    session_id = store.create(make_board())
+    body = {
+        "boardSession": session_id,
+        "boardEdits": [column_edit("column-3", "word-3-0")],
+        "transducer": "internal",
+    }
+    resolved = resolve_board(body)
+    assert resolved["boardVersion"] == 1
+    assert resolved["transducer"] == "internal"
+    assert resolved["board"]["columns"] is resolved["columns"]
+    assert sorted(resolved["columns"]) == ["column-1", "column-2", "column-3"]
+    # refishing marks columns in place, which must not reach the store
+    resolved["columns"]["column-1"]["refishingStatus"] = "new"
+    del resolved["columns"]["column-2"]
+    _, board = store.get(session_id)
+    assert "refishingStatus" not in board["columns"]["column-1"]
+    assert "column-2" in board["columns"]
+    assert resolve_board({"columns": {}}) == {"columns": {}}
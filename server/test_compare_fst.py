@@ -0,0 +1,159 @@
+import random
+from collections import Counter
+
+from compare_fst import correspondence_patterns, reconstruct_versions
+
+
+def make_words(syllables):
+    """Words of one syllable each, from (doculect, ipa, gloss, positions, sounds)."""
+    words = {}
+    for i, (doculect, ipa, gloss, positions, sounds) in enumerate(syllables):
+        words["word-%d" % i] = {
+            "doculect": doculect,
+            "gloss": gloss,
+            "syllables": [ipa],
+            "syllables_parsed": [(positions, sounds)],
+        }
+    return words
+
+
+def counter_patterns(column_ids, columns, words, langs_under_study):
+    """Patterns of the columns as counted one by one with Counter, for comparison."""
+    patterns = []
+    for column_id in column_ids:
+        cnt = {}
+        sylls = {}
+        senses = {}
+        for syllable_id in columns[column_id]["syllableIds"]:
+            word_id, _, n = syllable_id.rpartition("-")
+            word = words[word_id]
+            n = int(n)
+            syllable_parsed = word["syllables_parsed"][n]
+            for position, sound in zip(
+                syllable_parsed[0].split(" "), syllable_parsed[1].split(" ")
+            ):
+                cnt.setdefault(position, {}).setdefault(word["doculect"], Counter())[
+                    sound
+                ] += 1
+                sylls.setdefault(position, {}).setdefault(
+                    word["doculect"], {}
+                ).setdefault(sound, []).append(word["syllables"][n])
+                senses.setdefault(position, {}).setdefault(
+                    word["doculect"], {}
+                ).setdefault(sound, []).append(word["gloss"])
+        column_patterns = []
+        for position in cnt:
+            description = []
+            most_common_ipas = []
+            shared_senses = []
+            last_present = False
+            any_non_last_present = False
+            for doculect in langs_under_study:
+                if doculect in cnt[position]:
+                    if doculect == langs_under_study[-1]:
+                        last_present = True
+                    else:
+                        any_non_last_present = True
+                    sound = cnt[position][doculect].most_common()[0][0]
+                    description.append(sound)
+                    most_common_ipas.append(
+                        Counter(sylls[position][doculect][sound]).most_common()[0][0]
+                    )
+                    shared_senses.extend(senses[position][doculect][sound])
+                else:
+                    description.append("-")
+                    most_common_ipas.append("--")
+            most_common_gloss = "?"
+            if shared_senses:
+                most_common_gloss = Counter(shared_senses).most_common()[0][0]
+            column_patterns.append(
+                (
+                    position,
+                    ":".join(description),
+                    most_common_ipas,
+                    most_common_gloss,
+                    last_present,
+                    any_non_last_present,
+                )
+            )
+        patterns.append(column_patterns)
+    return patterns
+
+
+def test_gloss_tie_goes_to_first_doculect_under_study():
+    # Bola and Maru tie on their glosses; rows of a doculect that is not
+    # studied come first, so Maru's row has a higher number than Bola's
+    syllables = [("Atsi", "pa", "other", "i", "p")] * 10
+    syllables += [("Bola", "pa", "bola gloss", "i", "p")]
+    syllables += [("Atsi", "pa", "other", "i", "p")] * 2
+    syllables += [("Maru", "pa", "maru gloss", "i", "p")]
+    words = make_words(syllables)
+    columns = {"column-1": {"syllableIds": ["%s-0" % w for w in words]}}
+    langs = ["Maru", "Bola"]
+
+    patterns = correspondence_patterns(["column-1"], columns, words, langs)
+    assert patterns[0][0][3] == "maru gloss"
+    assert patterns == counter_patterns(["column-1"], columns, words, langs)
+
+
+def test_patterns_match_counter():
+    rng = random.Random(1)
+    doculects = ["Maru", "Bola", "Atsi", "Lashi"]
+    for _ in range(200):
+        syllables = []
+        for _ in range(rng.randrange(1, 30)):
+            positions = rng.sample(["i", "m", "n", "c", "t"], rng.randrange(1, 4))
+            syllables.append(
+                (
+                    rng.choice(doculects),
+                    rng.choice(["pa", "ba", "ma"]),
+                    rng.choice(["g1", "g2", "g3"]),
+                    " ".join(positions),
+                    " ".join(rng.choice("pbm") for _ in positions),
+                )
+            )
+        words = make_words(syllables)
+        word_ids = list(words)
+        columns = {
+            "column-%d"
+            % k: {
+                "syllableIds": [
+                    "%s-0" % w
+                    for w in rng.sample(word_ids, rng.randrange(len(word_ids) + 1))
+                ]
+            }
+            for k in range(3)
+        }
+        langs = rng.sample(doculects, rng.randrange(1, 4))
+        column_ids = list(columns)
+        assert correspondence_patterns(
+            column_ids, columns, words, langs
+        ) == counter_patterns(column_ids, columns, words, langs)
+
+
+class StubFST(object):
+    """Network reconstructing every form as its name followed by the form."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def digest(self):
+        return "stub-" + self.name
+
+    def __ne__(self, other):
+        return self.name != other.name
+
+    def apply_up_many(self, words):
+        return {word: (self.name + word,) for word in words}
+
+
+def test_versions_of_board_leaving_out_a_doculect():
+    # Lashi has a network in both versions, unchanged, but no syllables
+    old = {"Maru": StubFST("m1"), "Bola": StubFST("b1"), "Lashi": StubFST("l1")}
+    new = {"Maru": StubFST("m2"), "Bola": old["Bola"], "Lashi": old["Lashi"]}
+    board_syllables = [("Maru", "pa"), ("Bola", "pa")]
+
+    recs, changed, affected, _ = reconstruct_versions([old, new], board_syllables)
+    assert changed == [set(), {"Maru"}]
+    assert recs[1] == {"Maru": {"pa": ("m2pa",)}, "Bola": {"pa": ("b1pa",)}}
+    assert affected[1] == {("Maru", "pa")}
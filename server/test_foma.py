@@ -0,0 +1,27 @@
+from ctypes.util import find_library
+
+import pytest
+
+if find_library("foma") is None:
+    pytest.skip("libfoma is not installed", allow_module_level=True)
+
+from foma import FST
+
+# kh, ts and tsh are multichar symbols overlapping each other and k, h, t, s
+MULTICHAR = "[K:kh | k | h | C:tsh | T:ts | t | s | a]*"
+
+WORDS = ["ka", "kha", "hka", "ta", "tsa", "tsha", "tssha", "khts", "ksh", "sa", "a"]
+
+
+def test_multichar_symbols():
+    assert FST(MULTICHAR).multichar_symbols() == {"kh", "ts", "tsh"}
+
+
+def test_wordlist_matches_apply_up_with_multichar_symbols():
+    fst = FST(MULTICHAR)
+    results = fst.apply_up_wordlist(WORDS)
+    assert set(results) == set(WORDS)
+    for word in WORDS:
+        assert set(results[word]) == set(fst.apply_up(word)), word
+    assert results["tsha"] == ("Ca",)
+    assert results["ksh"] == ("ksh",)
@@ -0,0 +1,89 @@
+from foma_script import FomaStatement, ScriptGraph, parse_script
+
+SCRIPT = """\
+# two targets, one built from A through B
+define A a b ;
+define B A c ;   # uses A
+define C d ;
+regex B ;
+save stack b.bin
+clear stack
+regex C ;
+save stack c.bin
+"""
+
+
+def fingerprints(script):
+    return set(f for f in ScriptGraph(parse_script(script)).fingerprints if f)
+
+
+def test_parse_script():
+    assert parse_script(SCRIPT) == [
+        FomaStatement("define", "A", "a b", 2),
+        FomaStatement("define", "B", "A c", 3),
+        FomaStatement("define", "C", "d", 4),
+        FomaStatement("regex", None, "B", 5),
+        FomaStatement("save", "b.bin", None, 6),
+        FomaStatement("clear", None, None, 7),
+        FomaStatement("regex", None, "C", 8),
+        FomaStatement("save", "c.bin", None, 9),
+    ]
+
+
+def test_parse_script_quotes_and_escapes():
+    statements = parse_script('define X "#;" %; # comment\n  b ;\npush X\npop stack\n')
+    assert statements == [
+        FomaStatement("define", "X", '"#;" %; \n  b', 1),
+        FomaStatement("push", "X", None, 3),
+        FomaStatement("pop", None, None, 4),
+    ]
+
+
+def test_parse_script_unsupported_commands():
+    statements = parse_script("read lexc maru.lexc\nsave stack\n")
+    assert [s.command for s in statements] == ["unsupported", "unsupported"]
+    assert statements[0].name == "read lexc maru.lexc"
+
+
+def test_parse_script_function_definitions_are_unsupported():
+    statements = parse_script(
+        "define F(X, Y) X Y ;\ndef G(X) [X | a] ;\nregex F(a, b) ;\n"
+    )
+    assert statements == [
+        FomaStatement("unsupported", "define F(X, Y)", None, 1),
+        FomaStatement("unsupported", "def G(X)", None, 2),
+        FomaStatement("regex", None, "F(a, b)", 3),
+    ]
+
+
+def test_dependencies():
+    graph = ScriptGraph(parse_script(SCRIPT))
+    assert graph.deps == [[], [0], [], [1], [3], [], [2], [6]]
+    assert graph.units() == [[0, 1, 3, 4], [2, 6, 7]]
+
+
+def test_fingerprints_ignore_comments_and_spacing():
+    edited = SCRIPT.replace("define A a b ;", "define A a b;  # same")
+    assert fingerprints(edited) == fingerprints(SCRIPT)
+
+
+def test_editing_a_define_only_needs_what_uses_it():
+    compiled = fingerprints(SCRIPT)
+    graph = ScriptGraph(parse_script(SCRIPT.replace("a b", "a e")))
+    # A, B which uses A, and the regex and save of B's target
+    assert graph.needed(lambda f: f in compiled) == {0, 1, 3, 4}
+
+
+def test_editing_nothing_needs_nothing_but_saves_from_cache():
+    compiled = fingerprints(SCRIPT)
+    graph = ScriptGraph(parse_script(SCRIPT))
+    assert graph.needed(lambda f: f in compiled) == set()
+    assert graph.needed(lambda f: False) == {0, 1, 2, 3, 4, 6, 7}
+
+
+def test_redefinition_changes_what_later_statements_use():
+    script = SCRIPT.replace("regex B ;", "define A x ;\nregex B ;")
+    graph = ScriptGraph(parse_script(script))
+    # B was defined with the first A, the regex uses B
+    assert graph.deps[4] == [1]
+    assert graph.fingerprints[4] == ScriptGraph(parse_script(SCRIPT)).fingerprints[3]
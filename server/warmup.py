@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# Startup warm-up of the server caches
+#
+# Compiles the configured transducers and builds the board of each configured
+# dataset once when the server starts, so the first /new-board does not pay for
+# parsing the TSV, compiling the transducer and reconstructing every syllable.
+#
+# The warm-up runs on a background thread by default. Under gunicorn with
+# `preload_app` (see gunicorn.conf.py) it runs to completion in the master
+# before the workers are forked, and they share the warmed caches
+# copy-on-write.
+
+import os
+import sys
+import threading
+import time
+
+from board_cache import compiled_board
+from fst_cache import compile_transducer
+
+
+def _names(variable, default=""):
+    return [
+        name.strip()
+        for name in os.environ.get(variable, default).split(",")
+        if name.strip()
+    ]
+
+
+# Datasets in /usr/app/data whose boards are built with their own transducer
+WARM_DATASETS = _names("CAPR_WARM_DATASETS", "burmish-aligned-final.tsv")
+# Further transducers in /usr/app/fsts to compile
+WARM_TRANSDUCERS = _names("CAPR_WARM_TRANSDUCERS")
+# Whether to warm up on a background thread instead of before serving
+WARM_BACKGROUND = os.environ.get("CAPR_WARM_BACKGROUND", "1") != "0"
+
+FSTS_DIR = "/usr/app/fsts"
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def warm_up(datasets=None, transducers=None):
+    """
+    Fill the transducer, reconstruction and board caches.
+
+    :param datasets: data file names, defaults to CAPR_WARM_DATASETS
+    :param transducers: transducer file names, defaults to CAPR_WARM_TRANSDUCERS
+    """
+    for name in transducers if transducers is not None else WARM_TRANSDUCERS:
+        started = time.monotonic()
+        try:
+            with open(os.path.join(FSTS_DIR, name), encoding="utf-8") as f:
+                compile_transducer(f.read())
+        except Exception as e:
+            eprint(f"Warm-up: could not compile {name}: {e}")
+        else:
+            eprint(f"Warm-up: compiled {name} in {time.monotonic() - started:.1f}s")
+
+    for name in datasets if datasets is not None else WARM_DATASETS:
+        started = time.monotonic()
+        try:
+            compiled_board(name)
+        except Exception as e:
+            eprint(f"Warm-up: could not build the board of {name}: {e}")
+        else:
+            eprint(f"Warm-up: built {name} in {time.monotonic() - started:.1f}s")
+
+
+def start_warm_up():
+    """Warm up the caches, on a daemon thread when CAPR_WARM_BACKGROUND is set."""
+    if not WARM_DATASETS and not WARM_TRANSDUCERS:
+        return
+    if WARM_BACKGROUND:
+        threading.Thread(target=warm_up, name="capr-warm-up", daemon=True).start()
+    else:
+        warm_up()